@@ -0,0 +1,349 @@
+"""Headless benchmarks for the compute and render paths of the RDKit - 3Dmol.js integration
+Times MinimizeLigand, AddPropToLigandDict, ExtractMolFragment, MolViewState.selectedModels and
+MolView3D.render3D (against a recording stand-in of the py3Dmol viewer) on synthetic or given
+ligand libraries and PDB complexes, and compares the results with a stored baseline.
+
+python Benchmark.py --output results.json
+python Benchmark.py --baseline results.json --tolerance 0.25
+"""
+
+from rdkit import Chem
+from rdkit import rdBase
+from rdkit.Chem import AllChem
+import numpy as np
+import argparse
+import functools
+import json
+import time
+import sys
+import os
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import IPythonConsoleIntegration
+from IPythonConsoleIntegration import MinimizeLigand, AddPropToLigandDict, MolViewState, MolView3D
+from IPythonConsoleIntegration import LazyLigandLibrary
+from LigandExtract import ExtractMolFragment
+
+SMILES = ('CC(=O)Oc1ccccc1C(=O)O', 'CN1CCC[C@H]1c1cccnc1', 'CC(C)Cc1ccc(cc1)C(C)C(=O)O',
+          'CN1C=NC2=C1C(=O)N(C(=O)N2C)C', 'CC(=O)Nc1ccc(O)cc1', 'OC[C@H]1OC(O)[C@H](O)[C@@H](O)[C@@H]1O',
+          'COc1ccc2[nH]cc(CCNC(C)=O)c2c1', 'CC(C)NCC(O)COc1cccc2ccccc12')
+
+LIGAND_RESNAME = 'LIG'
+
+# atom names and offsets (angstrom) of the alanine-like residues of the synthetic proteins
+RESIDUE_ATOMS = (('N', (0.0, 0.0, 0.0)), ('CA', (1.46, 0.0, 0.0)), ('C', (2.0, 1.42, 0.0)),
+                 ('O', (1.25, 2.4, 0.0)), ('CB', (2.0, -0.78, 1.21)))
+
+
+class RecordingView(object):
+    """ Stand-in for py3Dmol.view: records the names of the calls and the size of the models
+    instead of sending them to a browser """
+
+    def __init__(self):
+        self.calls = []
+        self.payloadBytes = 0
+
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            self.calls.append(name)
+            if name in ('addModel', 'addModelsAsFrames'):
+                self.payloadBytes += len(args[0])
+        return record
+
+
+class HeadlessMolView3D(MolView3D):
+    """ MolView3D rendering into a RecordingView, no widgets are displayed """
+
+    def RenderWidgetsWithViewer(self):
+        self.view = RecordingView()
+
+
+def _NoDisplay(*args, **kwargs):
+    pass
+
+
+def SyntheticLibrary(nMols, nConfs, seed = 42):
+    """ ligandDict of nMols molecules (cycling through SMILES) with nConfs embedded conformers each """
+    templates = {}
+    ligandDict = {}
+    for i in range(nMols):
+        smiles = SMILES[i % len(SMILES)]
+        if smiles not in templates:
+            mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+            AllChem.EmbedMultipleConfs(mol, numConfs = nConfs, randomSeed = seed)
+            templates[smiles] = mol
+        mol = Chem.Mol(templates[smiles])
+        mol.SetProp('_Name', 'mol_%d' % i)
+        ligandDict['mol_%d' % i] = {'parent': mol}
+    return ligandDict
+
+
+def LibraryFromSDF(path):
+    """ ligandDict read from an SD file (consecutive records with the same name are conformers) """
+    library = LazyLigandLibrary(path)
+    return dict((molId, {'parent': library[molId]['parent']}) for molId in library)
+
+
+def CopyLibrary(ligandDict):
+    """ Fresh copy of the parent molecules, for benchmarks writing into the ligandDict """
+    return dict((molId, {'parent': Chem.Mol(molData['parent'])}) for molId, molData in ligandDict.items())
+
+
+def _PDBAtomLine(record, serial, name, resName, chain, resNum, xyz, element):
+    return '%-6s%5d %-4s %3s %1s%4d    %8.3f%8.3f%8.3f%6.2f%6.2f          %2s' % (
+        record, serial, (' ' + name) if len(name) < 4 else name, resName, chain, resNum,
+        xyz[0], xyz[1], xyz[2], 1.0, 0.0, element)
+
+
+def SyntheticComplex(nResidues, ligand = None, spacing = 5.0):
+    """ mol object of a PDB complex: nResidues alanine-like residues on a cubic lattice around one
+    ligand (residue LIG of chain B) placed at the origin """
+    if ligand is None:
+        ligand = Chem.MolFromSmiles(SMILES[-1])
+        ligand = Chem.AddHs(ligand)
+        AllChem.EmbedMolecule(ligand, randomSeed = 42)
+        ligand = Chem.RemoveHs(ligand)
+    xyz = ligand.GetConformer().GetPositions()
+    xyz = xyz - xyz.mean(axis = 0)
+
+    # lattice points closest to the ligand, keeping residues clear of the ligand atoms
+    clearance = np.linalg.norm(xyz, axis = 1).max() + 2 * spacing
+    side = int(np.ceil((nResidues + (2 * clearance / spacing + 1) ** 3) ** (1.0 / 3))) + 1
+    axis = (np.arange(side) - side // 2) * spacing
+    points = np.array(np.meshgrid(axis, axis, axis, indexing = 'ij')).reshape(3, -1).T
+    distances = np.linalg.norm(points, axis = 1)
+    points = points[distances >= clearance]
+    points = points[np.argsort(distances[distances >= clearance], kind = 'stable')][:nResidues]
+
+    lines = []
+    serial = 0
+    for resNum, (x, y, z) in enumerate(points, 1):
+        for (name, offset) in RESIDUE_ATOMS:
+            serial += 1
+            lines.append(_PDBAtomLine('ATOM', serial, name, 'ALA', 'A', resNum,
+                                      (x + offset[0], y + offset[1], z + offset[2]), name[0]))
+
+    for i, atom in enumerate(ligand.GetAtoms()):
+        serial += 1
+        element = atom.GetSymbol()
+        lines.append(_PDBAtomLine('HETATM', serial, '%s%d' % (element, i + 1), LIGAND_RESNAME, 'B', 1,
+                                  xyz[i], element.upper()))
+    lines.append('END')
+
+    return Chem.MolFromPDBBlock('\n'.join(lines) + '\n', removeHs = False)
+
+
+def AllMolAndConfIds(ligandDict):
+    """ (molId, confId) of every conformer in ligandDict """
+    return tuple((molId, conf.GetId()) for molId in sorted(ligandDict)
+                 for conf in ligandDict[molId]['parent'].GetConformers())
+
+
+def Measure(func, setup = None, repeats = 3):
+    """ Best wall time of repeats calls of func(setup()), the growth of the resident memory during one
+    call run in a forked child (RDKit allocates outside the python heap, so this is the figure to gate
+    on) and the peak python heap of one extra traced call (tracemalloc slows the calls down, so timing
+    and tracing are done separately) """
+    # first, before the timing runs leave freed memory in the heap the child would inherit
+    peakRSS = ForkedRSSGrowth(func, setup)
+
+    best = None
+    for _ in range(repeats):
+        arg = setup() if setup is not None else None
+        start = time.time()
+        func(arg)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    pythonPeak = None
+    if tracemalloc is not None:
+        arg = setup() if setup is not None else None
+        tracemalloc.start()
+        func(arg)
+        pythonPeak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peakRSS, pythonPeak
+
+
+def MaxRSS():
+    """ Peak resident memory of the process in bytes (None where the resource module is missing) """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _ResetMaxRSS():
+    """ Sets the peak resident memory back to the current one (linux only, elsewhere the peak of the
+    setup is included in the baseline of the measurement) """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def ForkedRSSGrowth(func, setup = None):
+    """ Bytes the peak resident memory grows by while func(setup()) runs in a forked child process
+    (None where fork or the resource module is missing) """
+    if resource is None or not hasattr(os, 'fork'):
+        return None
+    readFd, writeFd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(readFd)
+            arg = setup() if setup is not None else None
+            _ResetMaxRSS()
+            before = MaxRSS()
+            func(arg)
+            os.write(writeFd, str(MaxRSS() - before).encode())
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(writeFd)
+    with os.fdopen(readFd) as f:
+        growth = f.read()
+    os.waitpid(pid, 0)
+    return int(growth) if growth else None
+
+
+def _Minimize(ff, maxIters, ligandDict):
+    MinimizeLigand(ligandDict, ff = ff, maxIters = maxIters)
+
+
+def _Extract(protein, _):
+    ExtractMolFragment(protein, LIGAND_RESNAME)
+
+
+def Benchmarks(ligandDict, complexes, maxIters = 200):
+    """ (name, unit, number of items, setup, func) of every benchmark """
+    nConfs = sum(molData['parent'].GetNumConformers() for molData in ligandDict.values())
+    allIds = AllMolAndConfIds(ligandDict)
+    benchmarks = []
+
+    for ff in ('UFF', 'MMFF'):
+        benchmarks.append(('MinimizeLigand_%s' % ff, 'conformers/s', nConfs,
+                           lambda: CopyLibrary(ligandDict),
+                           functools.partial(_Minimize, ff, maxIters)))
+
+    benchmarks.append(('AddPropToLigandDict', 'molecules/s', len(ligandDict),
+                       lambda: CopyLibrary(ligandDict),
+                       lambda lib: AddPropToLigandDict(lib)))
+
+    def selectedModelsSetup():
+        state = MolViewState(ligandDict, None)
+        state.parseIds(allIds)
+        return state
+    benchmarks.append(('MolViewState.selectedModels', 'models/s', len(allIds),
+                       selectedModelsSetup,
+                       lambda state: list(state.selectedModels)))
+
+    for name, protein in complexes:
+        benchmarks.append(('ExtractMolFragment_%s' % name, 'atoms/s', protein.GetNumAtoms(),
+                           None,
+                           functools.partial(_Extract, protein)))
+
+        viewer = HeadlessMolView3D(ligandDict = ligandDict, protein = protein, stylePanel = 'ligprot')
+        def renderSetup(viewer = viewer):
+            viewer.ClearScene()
+            viewer.molViewState.clearBlockCache()
+            viewer.molViewState.proteinBlockCache = {}
+            return viewer
+        benchmarks.append(('MolView3D.render3D_%s' % name, 'models/s', len(allIds) + 1,
+                           renderSetup,
+                           lambda viewer: viewer.SelectMolAndConf(molAndConfIds = allIds)))
+    return benchmarks
+
+
+def RunBenchmarks(ligandDict, complexes, repeats = 3, maxIters = 200, only = None):
+    """ Runs all benchmarks (or those whose name starts with one of only) and returns the results """
+    # render3D calls IPython's display, which would print the recorded view outside a notebook
+    IPythonConsoleIntegration.display = _NoDisplay
+
+    results = {}
+    for (name, unit, nItems, setup, func) in Benchmarks(ligandDict, complexes, maxIters):
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        seconds, peakRSS, pythonPeak = Measure(func, setup, repeats)
+        results[name] = {'seconds': seconds, 'items': nItems, 'unit': unit,
+                         'throughput': nItems / seconds if seconds > 0 else float('inf'),
+                         'peakRSS': peakRSS, 'pythonHeapPeak': pythonPeak}
+        sys.stdout.write('%-40s %10.4f s %14.1f %-13s %12s bytes RSS %10s bytes python heap\n' % (
+            name, seconds, results[name]['throughput'], unit, peakRSS, pythonPeak))
+        sys.stdout.flush()
+    return results
+
+
+def CompareWithBaseline(results, baseline, tolerance = 0.25):
+    """ (name, metric, baseline value, new value) of every result worse than the baseline by more than tolerance """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        # the python heap peak misses RDKit's allocations and is only reported
+        for metric in ('seconds', 'peakRSS'):
+            old = baseline[name].get(metric)
+            new = result.get(metric)
+            if old and new is not None and new > old * (1 + tolerance):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'headless benchmarks of IPythonConsoleIntegration and LigandExtract')
+    parser.add_argument('--mols', type = int, default = 20, help = 'molecules of the synthetic library')
+    parser.add_argument('--confs', type = int, default = 10, help = 'conformers per molecule of the synthetic library')
+    parser.add_argument('--residues', default = '100,1000,5000', help = 'sizes of the synthetic complexes')
+    parser.add_argument('--sdf', help = 'ligand library (SD file) used instead of the synthetic one')
+    parser.add_argument('--pdb', action = 'append', default = [],
+                        help = 'PDB complex with a ligand named LIG, used in addition to the synthetic ones')
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--max-iters', type = int, default = 200)
+    parser.add_argument('--only', action = 'append', help = 'run only the benchmarks starting with this name')
+    parser.add_argument('--output', help = 'write the results as JSON (e.g. a new baseline)')
+    parser.add_argument('--baseline', help = 'JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type = float, default = 0.25, help = 'allowed slowdown, 0.25 = 25 %%')
+    args = parser.parse_args(argv)
+
+    if args.sdf:
+        ligandDict = LibraryFromSDF(args.sdf)
+    else:
+        ligandDict = SyntheticLibrary(args.mols, args.confs)
+
+    complexes = [('%dres' % int(n), SyntheticComplex(int(n))) for n in args.residues.split(',') if n]
+    complexes.extend((path, Chem.MolFromPDBFile(path, removeHs = False)) for path in args.pdb)
+
+    results = RunBenchmarks(ligandDict, complexes, args.repeats, args.max_iters, args.only)
+    report = {'results': results, 'maxRSS': MaxRSS(), 'rdkit': rdBase.rdkitVersion,
+              'python': sys.version.split()[0], 'config': vars(args)}
+    sys.stdout.write('peak resident memory: %s bytes\n' % report['maxRSS'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = CompareWithBaseline(results, baseline, args.tolerance)
+        for (name, metric, old, new) in regressions:
+            sys.stdout.write('REGRESSION %s %s: %s -> %s\n' % (name, metric, old, new))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,16 +14,34 @@ try:
 except ImportError:
     _canUse3D = False
     
+try:
+    from tornado.ioloop import IOLoop
+    _canDebounce = True
+except ImportError:
+    _canDebounce = False
+    
 from rdkit import Chem
 from rdkit.Chem import AllChem
 from rdkit.Chem import Descriptors
+from rdkit.ML.Cluster import Butina
 from ipywidgets import Layout, Label, Button, Box, HBox, VBox
 from ipywidgets import Dropdown, HTML, Checkbox, Button
 from IPython.display import display
 from IPython.display import HTML as scriptHTML
+from LigandExtract import ResidueGrid, MolFromAtomIds, SetConformerPositions
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
 import time
 import sys
-import copy
+import os
+import functools
+import sqlite3
 
 PY3 = sys.version_info[0] >= 3
 
@@ -31,10 +49,20 @@ BGCOLORS_3D = ('0x000000', '0xeeeeee', '0xffffff')
 
 PROP_RDKIT = tuple(sorted(prop for prop, _ in Descriptors._descList))
 
+_DESCRIPTOR_FUNCS = dict(Descriptors._descList)
+
 DRAWING_LIGAND_3D=('line', 'cross', 'stick', 'sphere', 'surface', 'ballstick')
 
 DRAWING_PROTEIN_3D=('line', 'cartoon', 'surface')
 
+PROTEIN_MODEL_KEY = ('protein', None, None)
+
+# confId of the model holding all conformers of a molecule as frames
+CONF_FRAMES = 'frames'
+
+# every conformer of a molecule (same keyword as molAndConfIds of MinimizeLigand)
+ALL_CONFORMERS = 'allConfs'
+
 LIGAND_COLOR_SCHEME_3D=('default', 'greenCarbon', 'cyanCarbon', 'magentaCarbon',
                         'yellowCarbon', 'whiteCarbon', 'orangeCarbon', 'purpleCarbon', 
                         'blueCarbon', 'ssPyMOL', 'ssJmol', 'Jmol', 'amino', 
@@ -84,26 +112,385 @@ def ProcessLigandDict(ligandDict, keyForParentMol = 'parent'):
         
     return newLigandDict
     
-def MinimizeLigand(ligandDict, 
-                   keyForParentMol = 'parent', keyForMinimizedMol = 'minimized',
-                   energyDataKey = 'energy',
-                   molAndConfIds = 'allConfs', 
-                   ff = 'UFF', 
-                   maxIters = 50):
+class LigandEntry(MutableMapping):
+    """ Data of one molecule of a LazyLigandLibrary; the parent molecule is parsed on access and may 
+    be evicted by the library, everything else stored here (minimized, energy, ...) is kept. A parent 
+    assigned through entry[keyForParentMol] = mol is kept here too and never evicted. Properties set 
+    with SetParentProps are kept as strings and put on the parent again whenever it is parsed """
+    
+    def __init__(self, library, molId):
+        self.library = library
+        self.molId = molId
+        self.data = {}
+        # parent molecule set by the user, None while the one in the file is used
+        self.parentMol = None
+        # {property name: value} put on the parent every time it is parsed
+        self.parentProps = {}
+        
+    def SetParentProps(self, props):
+        """ Set {property name: str value} on the parent and keep them across evictions """
+        self.parentProps.update(props)
+        mol = self[self.library.keyForParentMol]
+        for name, value in props.items():
+            mol.SetProp(name, value)
+        
+    def __getitem__(self, key):
+        if key == self.library.keyForParentMol:
+            if self.parentMol is not None:
+                return self.parentMol
+            return self.library.GetParentMol(self.molId)
+        return self.data[key]
+        
+    def __setitem__(self, key, value):
+        if key == self.library.keyForParentMol:
+            self.library.SetParentMol(self.molId, value)
+        else:
+            self.data[key] = value
+            
+    def __delitem__(self, key):
+        if key == self.library.keyForParentMol:
+            raise KeyError("parent molecule of a LazyLigandLibrary can't be deleted")
+        del self.data[key]
+        
+    def __iter__(self):
+        yield self.library.keyForParentMol
+        for key in self.data:
+            yield key
+            
+    def __len__(self):
+        return len(self.data) + 1
+        
+        
+class LazyLigandLibrary(Mapping):
+    """ Ligand dictionary backed by an SDF file. The byte offsets of the records are indexed once, 
+    molecules are parsed when accessed and the least recently used ones are evicted. Consecutive 
+    records with the same name are read as conformers of one molecule; a name that reappears after 
+    other records gets the key name_<recordNo>. Only parsed parents are evicted: a parent assigned with 
+    library[molId][keyForParentMol] = mol stays in memory for good, so assigning every parent costs as 
+    much memory as a plain dict (properties belong in LigandEntry.SetParentProps or a DescriptorTable) """
+    
+    def __init__(self, path, keyForParentMol = 'parent', cacheSize = 256, removeHs = False):
+        self.path = path
+        self.keyForParentMol = keyForParentMol
+        self.cacheSize = cacheSize
+        self.removeHs = removeHs
+        # {molId: [(offset, length) of every conformer record]}
+        self.index = OrderedDict()
+        self.entries = {}
+        # parsed parent molecules {molId: mol}, least recently used first
+        self.parsed = OrderedDict()
+        self.parseCount = 0
+        self.BuildIndex()
+        
+    def BuildIndex(self):
+        """ Scan the file once and record where every record starts and ends """
+        self.index = OrderedDict()
+        lastName = None
+        lastKey = None
+        nRecords = 0
+        with open(self.path, 'rb') as f:
+            offset = 0
+            start = 0
+            name = None
+            for line in f:
+                if name is None:
+                    name = line.strip().decode('utf-8', 'replace') or 'mol_%d' % nRecords
+                offset += len(line)
+                if line.startswith(b'$$$$'):
+                    if name == lastName:
+                        key = lastKey
+                    else:
+                        key = name if name not in self.index else '%s_%d' % (name, nRecords)
+                    self.index.setdefault(key, []).append((start, offset - start))
+                    lastName = name
+                    lastKey = key
+                    nRecords += 1
+                    start = offset
+                    name = None
+                    
+    def NumConformers(self, molId):
+        """ Number of conformers of a molecule, known from the index without parsing """
+        return len(self.index[molId])
+        
+    def _ReadRecords(self, molId):
+        """ Raw text of all conformer records of a molecule """
+        records = []
+        with open(self.path, 'rb') as f:
+            for (offset, length) in self.index[molId]:
+                f.seek(offset)
+                records.append(f.read(length).decode('utf-8', 'replace'))
+        return records
+        
+    def _ParseRecord(self, record):
+        supplier = Chem.SDMolSupplier()
+        supplier.SetData(record, removeHs = self.removeHs)
+        mol = supplier[0]
+        if mol is None:
+            raise ValueError("could not parse a record of %s" % self.path)
+        return mol
+        
+    def _Parse(self, molId):
+        """ Parse all records of a molecule into one mol object with one conformer per record """
+        records = self._ReadRecords(molId)
+        mol = self._ParseRecord(records[0])
+        for record in records[1:]:
+            conformerMol = self._ParseRecord(record)
+            if conformerMol.GetNumAtoms() != mol.GetNumAtoms():
+                raise ValueError("conformers of %s differ in the number of atoms" % molId)
+            mol.AddConformer(Chem.Conformer(conformerMol.GetConformer()), assignId = True)
+        self.parseCount += 1
+        return mol
+        
+    def GetParentMol(self, molId):
+        """ Parent molecule, parsed on first access and kept in the LRU cache """
+        if molId not in self.index:
+            raise KeyError(molId)
+        if molId in self.entries and self.entries[molId].parentMol is not None:
+            return self.entries[molId].parentMol
+        if molId in self.parsed:
+            mol = self.parsed.pop(molId)
+        else:
+            mol = self._Parse(molId)
+            if molId in self.entries:
+                for name, value in self.entries[molId].parentProps.items():
+                    mol.SetProp(name, value)
+        self.parsed[molId] = mol
+        while len(self.parsed) > self.cacheSize:
+            self.parsed.popitem(last = False)
+        return mol
+        
+    def SetParentMol(self, molId, mol):
+        """ Replace the parent molecule; it is kept by the entry of the molecule, outside the cache """
+        self[molId].parentMol = mol
+        self.parsed.pop(molId, None)
+        
+    def __getitem__(self, molId):
+        if molId not in self.index:
+            raise KeyError(molId)
+        if molId not in self.entries:
+            self.entries[molId] = LigandEntry(self, molId)
+        return self.entries[molId]
+        
+    def __contains__(self, molId):
+        return molId in self.index
+        
+    def __iter__(self):
+        return iter(self.index)
+        
+    def __len__(self):
+        return len(self.index)
+        
+        
+class MinimizedConformers(object):
+    """ Coordinates of minimized conformers, one numpy array per conformer, and a topology-only 
+    copy of the parent molecule (no conformers, no properties) to build mol objects from """
+    
+    def __init__(self, parentMol):
+        self.topology = Chem.Mol(parentMol, True)
+        if parentMol.HasProp('_Name'):
+            self.topology.SetProp('_Name', parentMol.GetProp('_Name'))
+        self.positions = {}
+        self.versions = {}
+        self.loader = None
+        
+    @classmethod
+    def FromMol(cls, parentMol, mol):
+        """ Store all the conformers of a minimized mol object """
+        store = cls(parentMol)
+        for conf in mol.GetConformers():
+            store.SetPositions(conf.GetId(), conf.GetPositions())
+        return store
+        
+    def __contains__(self, confId):
+        return confId in self.positions
+        
+    def __len__(self):
+        return len(self.positions)
+        
+    def GetNumConformers(self):
+        """ Return the number of minimized conformers """
+        return len(self.positions)
+        
+    def GetConformerIds(self):
+        """ Return the ids of the minimized conformers """
+        return sorted(self.positions)
+        
+    def GetPositions(self, confId):
+        """ Return the (nAtoms, 3) coordinate array of a minimized conformer """
+        xyz = self.positions[confId]
+        if xyz is None:
+            xyz = self.positions[confId] = self.loader(confId)
+        return xyz
+        
+    def SetLazyPositions(self, confIds, loader):
+        """ Register minimized conformers whose coordinates are read with loader(confId) on first access """
+        self.loader = loader
+        for confId in confIds:
+            self.positions.setdefault(confId, None)
+        
+    def SetPositions(self, confId, xyz):
+        """ Store the coordinates of a minimized conformer """
+        xyz = np.array(xyz, dtype=np.float64)
+        if xyz.shape != (self.topology.GetNumAtoms(), 3):
+            raise ValueError("coordinates do not match the parent molecule")
+        self.positions[confId] = xyz
+        self.versions[confId] = self.versions.get(confId, 0) + 1
+        
+    def GetVersion(self, confId):
+        """ Number of times the coordinates of a conformer were written (0 if never or lazily loaded) """
+        return self.versions.get(confId, 0)
+        
+    def _NewMol(self):
+        """ Topology copy of the parent molecule without conformers """
+        return Chem.Mol(self.topology)
+        
+    def _AddConformer(self, mol, confId, xyz):
+        """ Add a conformer with given id and coordinates to mol """
+        conf = Chem.Conformer(mol.GetNumAtoms())
+        conf.SetId(confId)
+        conf.Set3D(True)
+        SetConformerPositions(conf, xyz)
+        mol.AddConformer(conf, assignId=False)
+        
+    def GetMol(self, confIds = None):
+        """ Materialize a mol object carrying the minimized conformers (all of them by default) """
+        mol = self._NewMol()
+        for confId in (self.GetConformerIds() if confIds is None else confIds):
+            self._AddConformer(mol, confId, self.GetPositions(confId))
+        return mol
+        
+    def GetWorkMol(self, confIds, parentMol):
+        """ Mol object with the given conformers to minimize: minimized coordinates if present, 
+        those of parentMol otherwise """
+        mol = self._NewMol()
+        for confId in sorted(set(confIds)):
+            if confId in self.positions:
+                xyz = self.GetPositions(confId)
+            else:
+                xyz = parentMol.GetConformer(confId).GetPositions()
+            self._AddConformer(mol, confId, xyz)
+        return mol
+        
+    def MolBlock(self, confId):
+        """ MolBlock of a single minimized conformer """
+        return Chem.MolToMolBlock(self.GetMol((confId,)), confId=confId)
+        
+        
+class MinimizationCheckpoint(object):
+    """ On-disk (SQLite) record of minimization results, one row per (molId, confId) """
+    
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.Connect().execute("""CREATE TABLE IF NOT EXISTS minimized (
+                                   molId TEXT NOT NULL, 
+                                   confId INTEGER NOT NULL, 
+                                   energy REAL, 
+                                   converged INTEGER, 
+                                   positions BLOB NOT NULL, 
+                                   PRIMARY KEY (molId, confId))""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS metadata (
+                                   key TEXT PRIMARY KEY, 
+                                   value TEXT NOT NULL)""")
+        self.connection.commit()
+        
+    def Connect(self):
+        """ Return the database connection, reopening it if it was closed """
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+        return self.connection
+        
+    def Close(self):
+        """ Close the underlying database; lazily rehydrated coordinates reopen it when needed """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+            
+    def CheckParameters(self, **parameters):
+        """ Record the minimization parameters in a new checkpoint, or raise ValueError if the 
+        checkpoint was written with different ones """
+        connection = self.Connect()
+        stored = dict(connection.execute("SELECT key, value FROM metadata"))
+        mismatched = ["%s=%s (checkpoint has %s)" % (key, value, stored[key]) 
+                      for key, value in sorted(parameters.items()) 
+                      if key in stored and stored[key] != str(value)]
+        if len(mismatched) > 0:
+            raise ValueError("checkpoint %s was written with other parameters: %s" 
+                             % (self.path, ", ".join(mismatched)))
+        connection.executemany("INSERT OR IGNORE INTO metadata VALUES (?, ?)", 
+                               [(key, str(value)) for key, value in parameters.items()])
+        connection.commit()
+        
+    def DoneIds(self):
+        """ Return the set of (molId, confId) pairs already stored """
+        return set(self.Connect().execute("SELECT molId, confId FROM minimized"))
+        
+    def Save(self, molId, minimized, positions):
+        """ Append {confId: (energy, converged)} and {confId: xyz} of one molecule and commit """
+        rows = [(molId, int(confId), float(energy), int(converged), 
+                 np.ascontiguousarray(positions[confId], dtype='<f8').tobytes())
+                for confId, (energy, converged) in minimized.items()]
+        connection = self.Connect()
+        connection.executemany("INSERT OR REPLACE INTO minimized VALUES (?, ?, ?, ?, ?)", rows)
+        connection.commit()
+        
+    def LoadPositions(self, molId, confId):
+        """ Read the minimized coordinates of one conformer """
+        row = self.Connect().execute("SELECT positions FROM minimized WHERE molId = ? AND confId = ?", 
+                                      (molId, int(confId))).fetchone()
+        if row is None:
+            raise KeyError((molId, confId))
+        return np.frombuffer(row[0], dtype='<f8').reshape(-1, 3).copy()
+        
+    def Rehydrate(self, ligandDict, 
+                  keyForParentMol = 'parent', keyForMinimizedMol = 'minimized',
+                  energyDataKey = 'energy', convergedDataKey = 'converged'):
+        """ Put stored results of the molecules in ligandDict back into it; energies are read now, 
+        coordinates when they are first used. Conformers that already have an energy in ligandDict 
+        are left as they are """
+        confIdsByMol = OrderedDict()
+        for molId, confId, energy, converged in self.Connect().execute(
+                "SELECT molId, confId, energy, converged FROM minimized ORDER BY molId, confId"):
+            if molId not in ligandDict or confId in ligandDict[molId].get(energyDataKey, {}):
+                continue
+            confIdsByMol.setdefault(molId, {})[confId] = (energy, bool(converged))
+            
+        for molId, minimized in confIdsByMol.items():
+            store = _GetMinimizedStore(ligandDict[molId], keyForParentMol, keyForMinimizedMol)
+            store.SetLazyPositions(list(minimized), functools.partial(self.LoadPositions, molId))
+            _StoreMinimizationResults(ligandDict[molId], minimized, energyDataKey, convergedDataKey)
+            
+        return ligandDict
+        
+        
+def _GroupConfIdsByMol(molAndConfIdsTuple):
+    """ Group (molId, confId) pairs into {molId: [confIds]} keeping the order of first appearance """
+    confIdsByMol = OrderedDict()
+    for (molId, confId) in molAndConfIdsTuple:
+        confIdsByMol.setdefault(molId, []).append(confId)
+    return confIdsByMol
+    
+def _MolWithConformers(mol, confIds):
+    """ Copy of mol (topology only) carrying just the given conformers, conformer ids are kept """
+    newMol = Chem.Mol(mol, True)
+    for confId in sorted(set(confIds)):
+        newMol.AddConformer(Chem.Conformer(mol.GetConformer(confId)), assignId=False)
+    return newMol
     
-    """ This function takes a dictionary of ligand and does energy minimization to the ligands"""
+def _ParseMinimizationJobs(ligandDict, molAndConfIds, ff, keyForParentMol):
+    """ Validate the minimization input and return the requested confIds grouped by molId """
     
     if ff not in ('MMFF', 'UFF'):
         raise TypeError("ff can be either MMFF or UFF")
         
-    if isinstance(ligandDict, dict) is False:
+    if isinstance(ligandDict, Mapping) is False:
         raise TypeError("ligandDict must be dict")
         
     if all(isinstance(key, str if PY3 else basestring) for key in ligandDict.keys()) is False:
         raise TypeError("keys of ligandDict must be str")
         
     
-    if molAndConfIds is 'allConfs':
+    if molAndConfIds == 'allConfs':
         molAndConfIdsTuple = ()
         for molId in list(ligandDict.keys()):
             mol = ligandDict[molId][keyForParentMol]
@@ -117,56 +504,807 @@ def MinimizeLigand(ligandDict,
     if all(isinstance(molId, str if PY3 else basestring) for (molId, confId) in molAndConfIdsTuple) is False:
         raise TypeError("keys of ligandDict must be str")
         
+    return _GroupConfIdsByMol(molAndConfIdsTuple)
+    
+def _GetMinimizedStore(molData, keyForParentMol, keyForMinimizedMol):
+    """ Return the minimized conformer store of a ligand, creating it on first use """
+    if keyForMinimizedMol not in list(molData.keys()):
+        molData[keyForMinimizedMol] = MinimizedConformers(molData[keyForParentMol])
+    elif not isinstance(molData[keyForMinimizedMol], MinimizedConformers):
+        # minimized molecule supplied as a full mol object
+        molData[keyForMinimizedMol] = MinimizedConformers.FromMol(molData[keyForParentMol], 
+                                                                  molData[keyForMinimizedMol])
+    return molData[keyForMinimizedMol]
+    
+def _GetForceFieldSetup(mol, ff):
+    """ Per-molecule force field setup: MMFF properties (atom typing) for MMFF, nothing for UFF """
+    if ff == 'MMFF':
+        props = AllChem.MMFFGetMoleculeProperties(mol)
+        if props is None:
+            raise ValueError("MMFF atom typing failed")
+        return props
+    return None
+    
+def _GetForceField(mol, ff, setup, confId):
+    """ Build the force field of one conformer from the per-molecule setup """
+    if ff == 'MMFF':
+        return AllChem.MMFFGetMoleculeForceField(mol, setup, confId=confId)
+    return AllChem.UFFGetMoleculeForceField(mol, confId=confId)
+    
+def _MinimizeMolConfs(mol, confIds, ff, maxIters, numThreads = 1):
+    """ Minimize the given conformers of mol in place and return {confId: (energy, converged)}
     
-    for Ids in molAndConfIdsTuple:
+    Atom typing and parameter lookup are done once per molecule: all requested conformers go through 
+    a single MMFFOptimizeMoleculeConfs / UFFOptimizeMoleculeConfs call (numThreads threads). If only 
+    a subset of conformers is requested, the call runs on a topology copy holding just those conformers.
+    Raises ValueError if MMFF cannot type every atom, instead of recording its (-1, -1.0) sentinel.
+    """
+    confIds = sorted(set(confIds))
+    
+    if confIds == sorted(conf.GetId() for conf in mol.GetConformers()):
+        workMol = mol
+    else:
+        workMol = _MolWithConformers(mol, confIds)
         
-        molId = Ids[0]
-        confId = Ids[1]
+    if ff == 'MMFF':
+        if not AllChem.MMFFHasAllMoleculeParams(workMol):
+            raise ValueError("MMFF atom typing failed")
+        results = AllChem.MMFFOptimizeMoleculeConfs(workMol, numThreads = numThreads, maxIters = maxIters)
+    else:
+        results = AllChem.UFFOptimizeMoleculeConfs(workMol, numThreads = numThreads, maxIters = maxIters)
+        
+    minimized = {}
+    for conf, (notConverged, energy) in zip(workMol.GetConformers(), results):
+        confId = conf.GetId()
+        if workMol is not mol:
+            SetConformerPositions(mol.GetConformer(confId), conf.GetPositions())
+        minimized[confId] = (energy, notConverged == 0)
+    return minimized
+    
+def _MinimizeMolConfsWorker(job):
+    """ Process pool worker: minimize the conformers of one molecule shipped as binary """
+    molId, molBinary, confIds, ff, maxIters, numThreads = job
+    mol = Chem.Mol(molBinary)
+    minimized = _MinimizeMolConfs(mol, confIds, ff, maxIters, numThreads)
+    positions = {confId: mol.GetConformer(confId).GetPositions() for confId in minimized}
+    return molId, positions, minimized
+    
+def _StoreMinimizationResults(molData, minimized, energyDataKey, convergedDataKey):
+    """ Write {confId: (energy, converged)} into the energy and convergence dicts of a ligand """
+    energy = molData.setdefault(energyDataKey, {})
+    converged = molData.setdefault(convergedDataKey, {})
+    for confId, (confEnergy, confConverged) in minimized.items():
+        energy[confId] = confEnergy
+        converged[confId] = confConverged
         
-        energy = ligandDict[molId].setdefault(energyDataKey, {})
+def MinimizeLigand(ligandDict, 
+                   keyForParentMol = 'parent', keyForMinimizedMol = 'minimized',
+                   energyDataKey = 'energy',
+                   molAndConfIds = 'allConfs', 
+                   ff = 'UFF', 
+                   maxIters = 50,
+                   nWorkers = 1,
+                   chunkSize = 1,
+                   numThreads = 1,
+                   convergedDataKey = 'converged',
+                   checkpoint = None):
+    
+    """ This function takes a dictionary of ligand and does energy minimization to the ligands
+    
+    nWorkers > 1 shards the molecules over a process pool (None uses all cores). Each worker gets 
+    one molecule (topology plus the requested conformers only) per job and sends back coordinates 
+    and energies, which are merged into ligandDict exactly as the serial path would store them.
+    
+    Conformers of one molecule are minimized together with a single force field setup, using 
+    numThreads threads. Minimized coordinates are kept in a MinimizedConformers store under 
+    keyForMinimizedMol (one coordinate array per minimized conformer, topology shared with the 
+    parent). Energies go to ligandDict[molId][energyDataKey][confId] as before and the convergence 
+    flag of each conformer to ligandDict[molId][convergedDataKey][confId].
+    
+    checkpoint (path of a SQLite file or a MinimizationCheckpoint) makes the run resumable: results 
+    are appended to the file molecule by molecule, pairs already in the file are skipped and their 
+    results are put back into ligandDict (coordinates are read from disk on first access). A 
+    checkpoint written with another ff or maxIters raises ValueError.
+    """
+    
+    if nWorkers is None:
+        nWorkers = os.cpu_count() if PY3 else 1
         
-        if keyForMinimizedMol not in list(ligandDict[molId].keys()):
-            oldMol = ligandDict[molId][keyForParentMol]
-            newMol = copy.deepcopy(oldMol)
-            ligandDict[molId][keyForMinimizedMol] = newMol
-        else:
-            newMol = ligandDict[molId][keyForMinimizedMol]
-            # print('molecule already exists with given key' + keyForMinimizedMol + 'using existing molecule')
-            
-        if ff == 'MMFF':
-            getFF = AllChem.MMFFGetMoleculeForceField(newMol, confId=confId)
-            getFF.Minimize(maxIts = maxIters)
-            energy[confId] = getFF.CalcEnergy()
-            
-        elif ff == 'UFF':
-            getFF = AllChem.UFFGetMoleculeForceField(newMol, confId=confId)
-            getFF.Minimize(maxIts = maxIters)
-            energy[confId] = getFF.CalcEnergy()
-        else:
-            raise ValueError("invalid conformer id")
+    if nWorkers < 1:
+        raise ValueError("nWorkers must be a positive integer")
+        
+    confIdsByMol = _ParseMinimizationJobs(ligandDict, molAndConfIds, ff, keyForParentMol)
+    
+    ownCheckpoint = checkpoint is not None and not isinstance(checkpoint, MinimizationCheckpoint)
+    if ownCheckpoint:
+        checkpoint = MinimizationCheckpoint(checkpoint)
+        
+    if checkpoint is not None:
+        checkpoint.CheckParameters(ff = ff, maxIters = maxIters)
+        checkpoint.Rehydrate(ligandDict, keyForParentMol, keyForMinimizedMol, energyDataKey, convergedDataKey)
+        doneIds = checkpoint.DoneIds()
+        todo = OrderedDict()
+        for molId, confIds in confIdsByMol.items():
+            confIds = [confId for confId in confIds if (molId, confId) not in doneIds]
+            if len(confIds) > 0:
+                todo[molId] = confIds
+        confIdsByMol = todo
+        
+    for molId in confIdsByMol:
+        _GetMinimizedStore(ligandDict[molId], keyForParentMol, keyForMinimizedMol)
+        
+    def storeResults(molId, positions, minimized):
+        store = ligandDict[molId][keyForMinimizedMol]
+        for confId, xyz in positions.items():
+            store.SetPositions(confId, xyz)
+        _StoreMinimizationResults(ligandDict[molId], minimized, energyDataKey, convergedDataKey)
+        if checkpoint is not None:
+            checkpoint.Save(molId, minimized, positions)
+            
+            
+    if nWorkers == 1:
+        
+        for molId, confIds in confIdsByMol.items():
+            workMol = ligandDict[molId][keyForMinimizedMol].GetWorkMol(confIds, ligandDict[molId][keyForParentMol])
+            minimized = _MinimizeMolConfs(workMol, confIds, ff, maxIters, numThreads)
+            positions = {confId: workMol.GetConformer(confId).GetPositions() for confId in minimized}
+            storeResults(molId, positions, minimized)
+            
+    else:
+        
+        jobs = ((molId, 
+                 ligandDict[molId][keyForMinimizedMol].GetWorkMol(
+                     confIds, ligandDict[molId][keyForParentMol]).ToBinary(Chem.PropertyPickleOptions.CoordsAsDouble), 
+                 confIds, ff, maxIters, numThreads) for molId, confIds in confIdsByMol.items())
+        
+        with ProcessPoolExecutor(max_workers = nWorkers) as executor:
+            for molId, positions, minimized in executor.map(_MinimizeMolConfsWorker, jobs, 
+                                                            chunksize = chunkSize):
+                storeResults(molId, positions, minimized)
+                
+    if ownCheckpoint:
+        checkpoint.Close()
+        
+    return ligandDict
+    
+    
+def MinimizeLigandInRounds(ligandDict, 
+                           keyForParentMol = 'parent', keyForMinimizedMol = 'minimized',
+                           energyDataKey = 'energy',
+                           molAndConfIds = 'allConfs', 
+                           ff = 'UFF', 
+                           maxIters = 50,
+                           itersGrowth = 2,
+                           maxRounds = 5,
+                           maxTotalIters = None,
+                           timeBudget = None,
+                           convergedDataKey = 'converged',
+                           diagnosticsDataKey = 'diagnostics'):
+    
+    """ Energy minimization in rounds that re-queues only the conformers which did not converge
+    
+    Round r gives every pending conformer maxIters * itersGrowth**r iterations, all conformers of a 
+    round are done before the next round starts. The run stops when all conformers converged, after 
+    maxRounds rounds, when the next minimization would exceed maxTotalIters iterations in total, or 
+    after timeBudget seconds. Only the queue of pending (molId, confId) pairs is kept across rounds: 
+    force fields are built one molecule at a time from the stored coordinates and dropped after use. 
+    Energies and convergence flags are stored as in MinimizeLigand, and 
+    ligandDict[molId][diagnosticsDataKey][confId] holds a dict with iterations, rounds, converged, 
+    wallTime, initialEnergy and finalEnergy (None for conformers the budget did not reach). RDKit only 
+    reports whether Minimize converged, so iterations is the iteration budget spent on the conformer 
+    (an upper bound).
+    """
+    
+    if maxIters < 1 or itersGrowth < 1:
+        raise ValueError("maxIters and itersGrowth must be at least 1")
+        
+    confIdsByMol = _ParseMinimizationJobs(ligandDict, molAndConfIds, ff, keyForParentMol)
+    
+    startTime = time.time()
+    
+    # pending conformers {molId: [confIds]}, nothing else is kept across rounds
+    pending = OrderedDict()
+    for molId, confIds in confIdsByMol.items():
+        diagnostics = ligandDict[molId].setdefault(diagnosticsDataKey, {})
+        pending[molId] = sorted(set(confIds))
+        for confId in pending[molId]:
+            diagnostics[confId] = {'iterations': 0, 'rounds': 0, 'converged': False, 'wallTime': 0.0,
+                                   'initialEnergy': None, 'finalEnergy': None}
             
+    totalIters = 0
+    outOfBudget = False
+    
+    for roundId in range(maxRounds):
         
+        if len(pending) == 0 or outOfBudget:
+            break
+            
+        roundIters = int(maxIters * itersGrowth ** roundId)
         
+        for molId, confIds in list(pending.items()):
+            
+            molData = ligandDict[molId]
+            store = _GetMinimizedStore(molData, keyForParentMol, keyForMinimizedMol)
+            workMol = store.GetWorkMol(confIds, molData[keyForParentMol])
+            setup = _GetForceFieldSetup(workMol, ff)
+            
+            for confId in confIds:
+                
+                if timeBudget is not None and time.time() - startTime > timeBudget:
+                    outOfBudget = True
+                if maxTotalIters is not None and totalIters + roundIters > maxTotalIters:
+                    outOfBudget = True
+                if outOfBudget:
+                    break
+                    
+                confStart = time.time()
+                getFF = _GetForceField(workMol, ff, setup, confId)
+                diagnostics = molData[diagnosticsDataKey][confId]
+                if diagnostics['initialEnergy'] is None:
+                    diagnostics['initialEnergy'] = getFF.CalcEnergy()
+                notConverged = getFF.Minimize(maxIts = roundIters)
+                energy = getFF.CalcEnergy()
+                totalIters += roundIters
+                
+                diagnostics['iterations'] += roundIters
+                diagnostics['rounds'] += 1
+                diagnostics['wallTime'] += time.time() - confStart
+                diagnostics['converged'] = notConverged == 0
+                diagnostics['finalEnergy'] = energy
+                
+                store.SetPositions(confId, workMol.GetConformer(confId).GetPositions())
+                _StoreMinimizationResults(molData, {confId: (energy, notConverged == 0)}, 
+                                          energyDataKey, convergedDataKey)
+                
+                if notConverged == 0:
+                    pending[molId].remove(confId)
+                    
+            if len(pending[molId]) == 0:
+                del pending[molId]
+            if outOfBudget:
+                break
+                
     return ligandDict
     
     
-def AddPropToLigandDict(ligandDict, keyForParentMol = 'parent'):
+BACKBONE_ATOM_NAMES = ('N', 'CA', 'C', 'O', 'OXT')
+
+def _PocketForceField(mol, ff, cutoff):
+    """ Force field of mol (one conformer) with non-bonded terms beyond about cutoff left out; UFF 
+    takes the threshold in multiples of the van der Waals distance of a pair (3-4 A for C, N, O) """
+    if ff == 'MMFF':
+        props = AllChem.MMFFGetMoleculeProperties(mol)
+        if props is None:
+            raise ValueError("MMFF atom typing failed")
+        forceField = AllChem.MMFFGetMoleculeForceField(mol, props, nonBondedThresh = cutoff, 
+                                                       ignoreInterfragInteractions = False)
+    else:
+        forceField = AllChem.UFFGetMoleculeForceField(mol, vdwThresh = cutoff / 3.0, 
+                                                      ignoreInterfragInteractions = False)
+    if forceField is None:
+        raise ValueError("could not set up the force field")
+    return forceField
+    
+def _FragmentEnergy(mol, ff, xyz, cutoff):
+    """ Energy of mol (one conformer) at the coordinates xyz """
+    return _PocketForceField(mol, ff, cutoff).CalcEnergy(np.ravel(xyz).tolist())
+    
+def _SingleConformerMol(mol, confId):
+    """ Topology copy of mol with one conformer (id 0) """
+    newMol = Chem.Mol(mol, True)
+    conf = Chem.Conformer(mol.GetConformer(confId))
+    conf.SetId(0)
+    newMol.AddConformer(conf, assignId=False)
+    return newMol
+    
+def MinimizeLigandInPocket(ligandDict, 
+                           protein, 
+                           keyForParentMol = 'parent', keyForMinimizedMol = 'minimized',
+                           energyDataKey = 'energy',
+                           interactionDataKey = 'interactionEnergy',
+                           molAndConfIds = 'allConfs', 
+                           ff = 'UFF', 
+                           maxIters = 200,
+                           cutoff = 8.0,
+                           flexibleSideChains = False,
+                           flexibleCutoff = 4.0,
+                           convergedDataKey = 'converged',
+                           proteinConfId = -1):
+    """ Minimize ligands inside the binding pocket of protein with the protein held fixed
+    
+    For every conformer only the protein residues within cutoff of the ligand are kept; they are 
+    combined with the ligand into one force field (including ligand-protein interactions) in which 
+    all protein atoms are fixed points, except the side chains of residues within flexibleCutoff of 
+    the ligand if flexibleSideChains (flexibleCutoff can't exceed cutoff). Non-bonded terms are cut 
+    off at about cutoff as well. The minimized ligand coordinates go to the MinimizedConformers 
+    store under keyForMinimizedMol, the ligand energy to energyDataKey and the interaction energy 
+    (complex minus ligand minus pocket) to interactionDataKey, both {confId: energy}. A conformer 
+    with no residue within cutoff is minimized on its own with an interaction energy of 0.
+    """
+    if flexibleSideChains and flexibleCutoff > cutoff:
+        raise ValueError("flexibleCutoff can't be larger than cutoff")
+        
+    confIdsByMol = _ParseMinimizationJobs(ligandDict, molAndConfIds, ff, keyForParentMol)
+    
+    grid = ResidueGrid(protein, confId = proteinConfId)
+    
+    for molId, confIds in confIdsByMol.items():
+        molData = ligandDict[molId]
+        store = _GetMinimizedStore(molData, keyForParentMol, keyForMinimizedMol)
+        parent = molData[keyForParentMol]
+        
+        for confId in confIds:
+            ligand = _SingleConformerMol(parent, confId)
+            ligandXyz = ligand.GetConformer().GetPositions()
+            nLigandAtoms = ligand.GetNumAtoms()
+            
+            pocketAtomIds = grid.ResidueAtomsWithin(ligandXyz, cutoff)
+            if len(pocketAtomIds) > 0:
+                pocket = MolFromAtomIds(protein, pocketAtomIds, confId = proteinConfId)
+                pocket.GetConformer().SetId(0)
+                complexMol = Chem.CombineMols(ligand, pocket)
+                # ring information for the atom typing
+                Chem.SanitizeMol(complexMol)
+            else:
+                pocket = None
+                complexMol = ligand
+                
+            try:
+                forceField = _PocketForceField(complexMol, ff, cutoff)
+            except ValueError as e:
+                raise ValueError("%s for the complex of %s" % (e, molId))
+                
+            flexible = set()
+            if flexibleSideChains:
+                pocketIndex = {atomId: i for i, atomId in enumerate(pocketAtomIds)}
+                for key in grid.ResiduesWithin(ligandXyz, flexibleCutoff):
+                    for atomId in grid.residueIndex[key]:
+                        name = protein.GetAtomWithIdx(atomId).GetPDBResidueInfo().GetName().strip()
+                        if name not in BACKBONE_ATOM_NAMES:
+                            flexible.add(nLigandAtoms + pocketIndex[atomId])
+            for i in range(nLigandAtoms, complexMol.GetNumAtoms()):
+                if i not in flexible:
+                    forceField.AddFixedPoint(i)
+                    
+            forceField.Initialize()
+            notConverged = forceField.Minimize(maxIts = maxIters)
+            
+            xyz = np.array(forceField.Positions()).reshape(-1, 3)
+            complexEnergy = forceField.CalcEnergy()
+            if pocket is None:
+                ligandEnergy = complexEnergy
+                interactionEnergy = 0.0
+            else:
+                ligandEnergy = _FragmentEnergy(ligand, ff, xyz[:nLigandAtoms], cutoff)
+                pocketEnergy = _FragmentEnergy(pocket, ff, xyz[nLigandAtoms:], cutoff)
+                interactionEnergy = complexEnergy - ligandEnergy - pocketEnergy
+            
+            store.SetPositions(confId, xyz[:nLigandAtoms])
+            molData.setdefault(energyDataKey, {})[confId] = ligandEnergy
+            molData.setdefault(interactionDataKey, {})[confId] = interactionEnergy
+            molData.setdefault(convergedDataKey, {})[confId] = notConverged == 0
+            
+    return ligandDict
+    
+def AddPropToLigandDict(ligandDict, keyForParentMol = 'parent', descriptors = PROP_RDKIT):
     """ Add property to the mol """
     for molId in ligandDict:
         mol = ligandDict[molId][keyForParentMol]
-        for prop_name in PROP_RDKIT:
-            calculator = Descriptors.__dict__[prop_name]
-            mol.SetProp(prop_name, str(calculator(mol)))
+        props = {prop_name: str(_DESCRIPTOR_FUNCS[prop_name](mol)) for prop_name in descriptors}
+        if isinstance(ligandDict[molId], LigandEntry):
+            # kept by the entry, the parent itself may still be evicted and parsed again
+            ligandDict[molId].SetParentProps(props)
+        else:
+            for prop_name, value in props.items():
+                mol.SetProp(prop_name, value)
+            
+    return ligandDict
+    
+def _CalcDescriptors(mol, descriptors):
+    """ Descriptor values of one molecule as floats, nan where the calculation fails """
+    values = []
+    for prop_name in descriptors:
+        try:
+            values.append(float(_DESCRIPTOR_FUNCS[prop_name](mol)))
+        except Exception:
+            values.append(np.nan)
+    return values
+    
+def _CalcDescriptorsWorker(job):
+    """ Process pool worker: descriptor values of one molecule shipped as binary """
+    molBinary, descriptors = job
+    return _CalcDescriptors(Chem.Mol(molBinary), descriptors)
+    
+class DescriptorTable(object):
+    """ Descriptor values as a float matrix (molecules x descriptors) with a molId index """
+    
+    def __init__(self, molIds, descriptors, values):
+        self.molIds = list(molIds)
+        self.descriptors = tuple(descriptors)
+        self.values = np.asarray(values, dtype=np.float64).reshape(len(self.molIds), len(self.descriptors))
+        self.molIndex = {molId: i for i, molId in enumerate(self.molIds)}
+        self.descriptorIndex = {prop_name: j for j, prop_name in enumerate(self.descriptors)}
+        
+    def __contains__(self, molId):
+        return molId in self.molIndex
+        
+    def __len__(self):
+        return len(self.molIds)
+        
+    def GetValue(self, molId, prop_name):
+        """ Value of one descriptor for one molecule """
+        return self.values[self.molIndex[molId], self.descriptorIndex[prop_name]]
+        
+    def GetRow(self, molId):
+        """ All descriptor values of one molecule as {descriptor: value} """
+        row = self.values[self.molIndex[molId]]
+        return OrderedDict(zip(self.descriptors, row.tolist()))
+        
+    def GetColumn(self, prop_name):
+        """ Values of one descriptor for all molecules (in the order of molIds) """
+        return self.values[:, self.descriptorIndex[prop_name]]
+        
+    def Filter(self, prop_name, minValue = None, maxValue = None):
+        """ molIds whose descriptor value lies within [minValue, maxValue] """
+        column = self.GetColumn(prop_name)
+        keep = ~np.isnan(column)
+        if minValue is not None:
+            keep &= column >= minValue
+        if maxValue is not None:
+            keep &= column <= maxValue
+        return [self.molIds[i] for i in np.flatnonzero(keep)]
+        
+    def Sort(self, prop_name, reverse = False, molIds = None):
+        """ molIds (all or the given ones) sorted by a descriptor, molecules without value last """
+        if molIds is None:
+            rows = np.arange(len(self.molIds))
+        else:
+            rows = np.array([self.molIndex[molId] for molId in molIds], dtype=int)
+        column = self.values[rows, self.descriptorIndex[prop_name]]
+        order = np.argsort(-column if reverse else column, kind='stable')
+        return [self.molIds[i] for i in rows[order]]
+        
+    def Select(self, descriptors):
+        """ New table holding only the given descriptors """
+        columns = [self.descriptorIndex[prop_name] for prop_name in descriptors]
+        return DescriptorTable(self.molIds, descriptors, self.values[:, columns])
+        
+        
+class EnergyTable(object):
+    """ Conformer energies as arrays (one row per minimized conformer, grouped by molecule) for 
+    vectorized queries; the queries return (molId, confId) pairs as accepted by 
+    MolView3D.SelectMolAndConf(molAndConfIds = ...) """
+    
+    def __init__(self, molIds, confIds, energies, converged = None):
+        molIds = list(molIds)
+        self.molIds = list(OrderedDict.fromkeys(molIds))
+        self.molIndex = {molId: i for i, molId in enumerate(self.molIds)}
+        
+        molRows = np.array([self.molIndex[molId] for molId in molIds], dtype=int)
+        confIds = np.asarray(confIds, dtype=int)
+        energies = np.asarray(energies, dtype=np.float64)
+        order = np.lexsort((confIds, molRows))
+        
+        self.molRows = molRows[order]
+        self.confIds = confIds[order]
+        self.energies = energies[order]
+        self.converged = None if converged is None else np.asarray(converged, dtype=bool)[order]
+        self.rowIndex = {(self.molIds[m], c): i for i, (m, c) in enumerate(zip(self.molRows.tolist(), 
+                                                                                self.confIds.tolist()))}
+        
+        # energy above the lowest conformer of the molecule
+        self.relativeEnergies = np.zeros(len(order))
+        if len(order) > 0:
+            groupStart = np.r_[True, np.diff(self.molRows) != 0]
+            minima = np.fmin.reduceat(self.energies, np.flatnonzero(groupStart))
+            self.relativeEnergies = self.energies - minima[np.cumsum(groupStart) - 1]
+            
+    @classmethod
+    def FromLigandDict(cls, ligandDict, energyDataKey = 'energy', convergedDataKey = 'converged'):
+        """ Table of the {confId: energy} dicts written by MinimizeLigand """
+        molIds, confIds, energies, converged = [], [], [], []
+        for molId in ligandDict:
+            molData = ligandDict[molId]
+            if energyDataKey not in molData:
+                continue
+            flags = molData.get(convergedDataKey, {})
+            for confId, energy in molData[energyDataKey].items():
+                molIds.append(molId)
+                confIds.append(confId)
+                energies.append(np.nan if energy is None else energy)
+                converged.append(bool(flags.get(confId, False)))
+        return cls(molIds, confIds, energies, converged)
+        
+    def __len__(self):
+        return len(self.energies)
+        
+    def __contains__(self, molAndConfId):
+        return tuple(molAndConfId) in self.rowIndex
+        
+    def _Pairs(self, rows):
+        return tuple((self.molIds[self.molRows[i]], int(self.confIds[i])) for i in rows)
+        
+    def GetEnergy(self, molId, confId):
+        """ Energy of one conformer """
+        return self.energies[self.rowIndex[(molId, confId)]]
+        
+    def GetRelativeEnergy(self, molId, confId):
+        """ Energy of one conformer above the lowest conformer of its molecule """
+        return self.relativeEnergies[self.rowIndex[(molId, confId)]]
+        
+    def LowestPerMolecule(self, k = 1, convergedOnly = False):
+        """ The k lowest energy conformers of every molecule """
+        valid = ~np.isnan(self.energies)
+        if convergedOnly and self.converged is not None:
+            valid &= self.converged
+        rows = np.flatnonzero(valid)
+        order = rows[np.lexsort((self.energies[rows], self.molRows[rows]))]
+        # rank of every row within its molecule
+        starts = np.flatnonzero(np.r_[True, np.diff(self.molRows[order]) != 0]) if len(order) > 0 else order
+        rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+        return self._Pairs(order[rank < k])
+        
+    def WithinWindow(self, window):
+        """ Conformers within window (energy units of the force field) of their molecule minimum """
+        return self._Pairs(np.flatnonzero(self.relativeEnergies <= window))
+        
+    def Ranking(self, n = None, relative = False):
+        """ Conformers of all molecules sorted by energy (or by energy above their molecule minimum), 
+        the first n or all """
+        values = self.relativeEnergies if relative else self.energies
+        rows = np.flatnonzero(~np.isnan(values))
+        order = rows[np.argsort(values[rows], kind='stable')]
+        return self._Pairs(order if n is None else order[:n])
+        
+        
+def CalcDescriptorTable(ligandDict, keyForParentMol = 'parent', descriptors = PROP_RDKIT, 
+                        nWorkers = 1, chunkSize = 16):
+    """ Calculate the given RDKit descriptors of every molecule into a DescriptorTable
+    
+    Unlike AddPropToLigandDict nothing is written to the molecules; with nWorkers > 1 the molecules 
+    are distributed over a process pool (None uses all cores).
+    """
+    descriptors = tuple(descriptors)
+    
+    unknown = [prop_name for prop_name in descriptors if prop_name not in _DESCRIPTOR_FUNCS]
+    if len(unknown) > 0:
+        raise KeyError("unknown descriptors: " + ', '.join(unknown))
+        
+    if nWorkers is None:
+        nWorkers = os.cpu_count() if PY3 else 1
+        
+    if nWorkers < 1:
+        raise ValueError("nWorkers must be a positive integer")
+        
+    molIds = list(ligandDict.keys())
+    
+    if nWorkers == 1:
+        values = [_CalcDescriptors(ligandDict[molId][keyForParentMol], descriptors) for molId in molIds]
+    else:
+        jobs = ((Chem.Mol(ligandDict[molId][keyForParentMol], True).ToBinary(), descriptors) for molId in molIds)
+        with ProcessPoolExecutor(max_workers = nWorkers) as executor:
+            values = list(executor.map(_CalcDescriptorsWorker, jobs, chunksize = chunkSize))
+            
+    return DescriptorTable(molIds, descriptors, values)
+    
+def _AlignedRMSD(X, Y):
+    """ RMSD after optimal superposition (Kabsch, from the singular values of the covariance) of 
+    coordinate sets X and Y of shape (..., nAtoms, 3); leading dimensions are broadcast """
+    X = X - X.mean(axis=-2, keepdims=True)
+    Y = Y - Y.mean(axis=-2, keepdims=True)
+    H = np.matmul(np.swapaxes(X, -1, -2), Y)
+    s = np.linalg.svd(H, compute_uv=False)
+    # reflection is not allowed: the smallest singular value changes sign
+    s[..., -1] *= np.sign(np.linalg.det(H))
+    E = (X * X).sum(axis=(-1, -2)) + (Y * Y).sum(axis=(-1, -2))
+    msd = (E - 2 * s.sum(axis=-1)) / X.shape[-2]
+    return np.sqrt(np.clip(msd, 0, None))
+    
+def _RMSDAtomIds(mol, heavyAtomsOnly):
+    if heavyAtomsOnly:
+        return [atom.GetIdx() for atom in mol.GetAtoms() if atom.GetAtomicNum() > 1]
+    return list(range(mol.GetNumAtoms()))
+    
+def _ConformerCoordinates(mol, confIds, atomIds):
+    """ Coordinates of the given atoms of the given conformers as array (conformers, atoms, 3) """
+    return np.array([mol.GetConformer(confId).GetPositions()[atomIds] for confId in confIds])
+    
+def ConformerRMSDMatrix(mol, confIds = None, heavyAtomsOnly = True, chunkSize = 256):
+    """ Pairwise RMSD matrix of the conformers of mol after optimal superposition, all pairs of 
+    a block of rows are computed at once (atom order as in mol, symmetry is not considered) """
+    if confIds is None:
+        confIds = [conf.GetId() for conf in mol.GetConformers()]
+    xyz = _ConformerCoordinates(mol, confIds, _RMSDAtomIds(mol, heavyAtomsOnly))
+    
+    matrix = np.zeros((len(confIds), len(confIds)))
+    for start in range(0, len(confIds), chunkSize):
+        matrix[start:start + chunkSize] = _AlignedRMSD(xyz[start:start + chunkSize, None], xyz[None, :])
+    np.fill_diagonal(matrix, 0.0)
+    return matrix
+    
+def CalcConformerRMSD(ligandDict, keyForParentMol = 'parent', rmsdDataKey = 'rmsd', 
+                      heavyAtomsOnly = True, recalc = False):
+    """ Store the conformer RMSD matrix of every molecule as ligandDict[molId][rmsdDataKey] = 
+    {'confIds': confIds, 'matrix': matrix}; matrices already there are kept unless recalc """
+    for molId in ligandDict:
+        molData = ligandDict[molId]
+        if rmsdDataKey in molData and not recalc:
+            continue
+        mol = molData[keyForParentMol]
+        confIds = [conf.GetId() for conf in mol.GetConformers()]
+        molData[rmsdDataKey] = {'confIds': confIds, 
+                                'matrix': ConformerRMSDMatrix(mol, confIds, heavyAtomsOnly)}
+    return ligandDict
+    
+def ClusterConformers(ligandDict, threshold = 0.5, keyForParentMol = 'parent', 
+                      rmsdDataKey = 'rmsd', clusterDataKey = 'clusters', heavyAtomsOnly = True):
+    """ Butina clustering of the conformers of every molecule on the (cached) RMSD matrix
+    
+    The clusters are stored as ligandDict[molId][clusterDataKey], a list of confId tuples with the 
+    cluster representative (centroid) first, largest cluster first.
+    """
+    CalcConformerRMSD(ligandDict, keyForParentMol, rmsdDataKey, heavyAtomsOnly)
+    
+    for molId in ligandDict:
+        molData = ligandDict[molId]
+        confIds = molData[rmsdDataKey]['confIds']
+        matrix = molData[rmsdDataKey]['matrix']
+        # lower triangle, row by row, as expected by Butina
+        rows, columns = np.tril_indices(len(confIds), -1)
+        clusters = Butina.ClusterData(matrix[rows, columns].tolist(), len(confIds), threshold, 
+                                      isDistData=True, reordering=True)
+        molData[clusterDataKey] = [tuple(confIds[i] for i in cluster) for cluster in clusters]
+    return ligandDict
+    
+def ClusterRepresentatives(ligandDict, molIds = None, clusterDataKey = 'clusters'):
+    """ (molId, confId) of the representative of every cluster, for MolView3D.SelectMolAndConf """
+    molIds = ligandDict.keys() if molIds is None else molIds
+    return tuple((molId, cluster[0]) for molId in molIds 
+                 for cluster in ligandDict[molId].get(clusterDataKey, ()))
+    
+def CalcMinimizationRMSD(ligandDict, keyForParentMol = 'parent', keyForMinimizedMol = 'minimized', 
+                         energyDataKey = 'energy', rmsdDataKey = 'minimizationRMSD', heavyAtomsOnly = True):
+    """ RMSD between parent and minimized coordinates of every conformer minimized by MinimizeLigand 
+    (those in the energy dict), stored as ligandDict[molId][rmsdDataKey] = {confId: rmsd} """
+    for molId in ligandDict:
+        molData = ligandDict[molId]
+        if energyDataKey not in molData or keyForMinimizedMol not in molData:
+            continue
+        parent = molData[keyForParentMol]
+        minimized = molData[keyForMinimizedMol]
+        atomIds = _RMSDAtomIds(parent, heavyAtomsOnly)
+        confIds = sorted(molData[energyDataKey])
+        
+        if isinstance(minimized, MinimizedConformers):
+            minimizedXyz = np.array([minimized.GetPositions(confId)[atomIds] for confId in confIds])
+        else:
+            minimizedXyz = _ConformerCoordinates(minimized, confIds, atomIds)
             
+        rmsd = _AlignedRMSD(_ConformerCoordinates(parent, confIds, atomIds), minimizedXyz)
+        molData[rmsdDataKey] = dict(zip(confIds, rmsd.tolist()))
     return ligandDict
     
+class LazyProperties(Mapping):
+    """ Properties of one molecule (mol properties, descriptor table values and RDKit descriptors); 
+    descriptors are only calculated when looked up, through the memo of MolViewState """
+    
+    def __init__(self, molViewState, molId):
+        self.molViewState = molViewState
+        self.molId = molId
+        self.propNames = molViewState.propNames(molId)
+        
+    def __getitem__(self, prop):
+        if prop not in self.propNames:
+            raise KeyError(prop)
+        return self.molViewState.getProperty(self.molId, prop)
+        
+    def __iter__(self):
+        return iter(self.propNames)
+        
+    def __len__(self):
+        return len(self.propNames)
+        
+        
+class ConformerSelection(object):
+    """ Selected conformers of every selected molecule. Conformers are kept per molecule as a set or 
+    as ALL_CONFORMERS, and selecting all molecules is a flag, so nothing grows with the library 
+    size; (molId, confId) pairs are generated when iterating """
+    
+    def __init__(self, molIds, numConformers):
+        # molIds: all molIds of the library, numConformers: function giving the conformer count of a molId
+        self.molIds = molIds
+        self.numConformers = numConformers
+        self.Clear()
+        
+    def Clear(self):
+        """ Nothing selected """
+        self.allMols = False
+        self.selectedMols = OrderedDict()
+        # {molId: set of confIds or ALL_CONFORMERS}, molecules without their own entry use defaultConfs
+        self.confs = {}
+        self.defaultConfs = {0}
+        
+    def SelectMolecules(self, molIds = None, add = False):
+        """ Select the given molecules (all molecules if molIds is None), or add them to the selection """
+        if molIds is None:
+            self.allMols = True
+        elif add:
+            if not self.allMols:
+                for molId in molIds:
+                    self.selectedMols[molId] = None
+        else:
+            self.allMols = False
+            self.selectedMols = OrderedDict((molId, None) for molId in molIds)
+            self.confs = dict((molId, self.confs[molId]) for molId in self.selectedMols if molId in self.confs)
+            
+    def SelectConformers(self, confIds = ALL_CONFORMERS, add = False):
+        """ For every selected molecule select the given conformers (all by default), or add them """
+        if confIds == ALL_CONFORMERS:
+            self.defaultConfs = ALL_CONFORMERS
+            self.confs = {}
+        elif add:
+            for molId, confs in list(self.confs.items()) + [(None, self.defaultConfs)]:
+                if confs != ALL_CONFORMERS:
+                    confs.update(confIds)
+        else:
+            self.defaultConfs = set(confIds)
+            self.confs = {}
+            
+    def Set(self, molAndConfIds):
+        """ Select exactly the given (molId, confId) pairs """
+        self.Clear()
+        for (molId, confId) in molAndConfIds:
+            self.selectedMols[molId] = None
+            self.confs.setdefault(molId, set()).add(confId)
+            
+    def SetConformers(self, molId, confIds):
+        """ Select exactly the given conformers of one (selected) molecule """
+        self.confs[molId] = set(confIds)
+        
+    def MolIds(self):
+        """ Selected molIds, in selection order (library order if all molecules are selected) """
+        if self.allMols:
+            return self.molIds
+        return self.selectedMols.keys()
+        
+    def ConfIds(self, molId):
+        """ Selected confIds of one molecule; confIds the molecule does not have are left out and a 
+        molecule left without any shows conformer 0 """
+        confs = self.confs.get(molId, self.defaultConfs)
+        nConformers = self.numConformers(molId)
+        if confs == ALL_CONFORMERS:
+            return range(nConformers)
+        confIds = sorted(confId for confId in confs if 0 <= confId < nConformers)
+        return confIds if len(confIds) > 0 else [0]
+        
+    def NumMolecules(self):
+        return len(self.MolIds())
+        
+    def __iter__(self):
+        for molId in self.MolIds():
+            for confId in self.ConfIds(molId):
+                yield (molId, confId)
+                
+    def __len__(self):
+        return sum(len(self.ConfIds(molId)) for molId in self.MolIds())
+        
+    def __contains__(self, molAndConfId):
+        molId, confId = molAndConfId
+        if not self.allMols and molId not in self.selectedMols:
+            return False
+        return confId in self.ConfIds(molId)
+        
+        
 class MolViewState(object):
     def __init__(self, 
                  molecules, 
                  protein, 
                  keyForParentMol = 'parent', 
                  keyForMinimizedMol = 'minimized',
-                 energyDataKey = 'energy'):
+                 energyDataKey = 'energy',
+                 descriptorTable = None,
+                 propCacheSize = 4096,
+                 blockCacheSize = 256):
         """ Molecules is dictionary of molecules """
         
         self.ligandDict = molecules
@@ -174,92 +1312,275 @@ class MolViewState(object):
         self.keyForParentMol = keyForParentMol
         self.keyForMinimizedMol = keyForMinimizedMol
         self.energyDataKey = energyDataKey
-        # These should have reasonable initial values
-        self.rdkit_mol_select = set()
-        self.rdkit_conf_select = set()
-        self.allConfIDs = []
+        self.descriptorTable = descriptorTable
+        # memo of lazily calculated descriptors {(molId, prop): value}, least recently used first
+        self.propCache = OrderedDict()
+        self.propCacheSize = propCacheSize
+        # serialized models {(molId, model category, confId): (coordinate version, MolBlock)}, LRU order
+        self.blockCache = OrderedDict()
+        self.blockCacheSize = blockCacheSize
+        self.blockCacheHits = 0
+        self.blockCacheMisses = 0
+        # serialized protein {(protein identity, confId): pdb block}, kept while the protein is unchanged
+        self.proteinConfId = -1
+        self.proteinBlockCache = {}
+        self.proteinBlockStats = {'serializationTime': 0.0, 'payloadBytes': 0, 'hits': 0, 'misses': 0}
+        # spatial index of the protein and the last pocket block (pocket atom ids, pdb block)
+        self.proteinGridCache = {}
+        self.pocketBlockCache = (None, None)
+        # selected (molId, confId) pairs
+        self.selection = ConformerSelection(molecules.keys() if molecules is not None else (), 
+                                            self.numConformers)
         
     def selectMolecules(self, selectAllMols, selectMultiMols, selectMol):
         """ Select either all moleculs or add selectMol or show only selectMol """
         if selectAllMols:
-            self.rdkit_mol_select = set(self.ligandDict)
+            self.selection.SelectMolecules()
         elif selectMultiMols:
-            self.rdkit_mol_select.add(selectMol)
+            self.selection.SelectMolecules((selectMol,), add = True)
         else:
-            self.rdkit_mol_select = {selectMol}
+            self.selection.SelectMolecules((selectMol,))
             
     def selectConformations(self, selectAllConfs, selectMultiConfs, selectConf):
-        """ For all selected molecules, select either all conformations or add selectConf or show only selectConf """
-        
-        for molIds in self.selectedMolNames:
+        """ For all selected molecules, select either all conformations or add selectConf or show only selectConf 
+        (each molecule within its own number of conformers) """
+        if selectAllConfs:
+            self.selection.SelectConformers()
+        elif selectMultiConfs:
+            self.selection.SelectConformers((selectConf,), add = True)
+        else:
+            self.selection.SelectConformers((selectConf,))
             
-            mol = self.ligandDict[molIds][self.keyForParentMol]
-            nConformers = mol.GetNumConformers()
+    def selectClusterRepresentatives(self, clusterDataKey = 'clusters', expandMolId = None, expandConfId = None):
+        """ Replace the selected conformers of every clustered molecule (see ClusterConformers) by the 
+        representatives of their clusters; the whole cluster of expandConfId of expandMolId is kept """
+        for molId in list(self.selection.MolIds()):
+            clusters = self.ligandDict[molId].get(clusterDataKey)
+            if not clusters:
+                continue
+            selected = set(self.selection.ConfIds(molId))
+            confIds = set(cluster[0] for cluster in clusters if selected.intersection(cluster))
+            if molId == expandMolId:
+                for cluster in clusters:
+                    if expandConfId in cluster:
+                        confIds.update(cluster)
+            self.selection.SetConformers(molId, confIds)
             
-            if nConformers > 1:
-                if selectAllConfs:
-                    self.rdkit_conf_select = set(range(nConformers))
-                elif selectMultiConfs:
-                    self.rdkit_conf_select.add(selectConf)
-                else:
-                    self.rdkit_conf_select = {selectConf}
-            elif mol.GetNumConformers() == 1:
-                self.rdkit_conf_select = {0}
-                
     def generateIds(self):
-        """generate paired id tuple from rdkit_mol_select and rdkit_conf_select"""
-        Ids = []
-        for molId in self.rdkit_mol_select:
-            for confId in self.rdkit_conf_select:
-                Ids.append((molId,confId))
-        self.idPaired = Ids
-        
-    def update_rdkit_select_unique_ids(self):
-        """generate unique molId and confId from paired id tuple"""
-        molIds = []
-        confIds = []
-        for (molId, confId) in self.idPaired:
-            molIds.append(molId)
-            confIds.append(confId)
-        self.rdkit_mol_select = set(molIds)
-        self.rdkit_conf_select = set(confIds)
+        """ kept for existing callers: the paired ids are generated from the selection when needed """
+        pass
         
     def parseIds(self, molAndConfIds):
         """ takes directly parsed paired id and store """
-        self.idPaired = molAndConfIds
-        self.update_rdkit_select_unique_ids()
+        self.selection.Set(molAndConfIds)
+        
+    @property
+    def idPaired(self):
+        """ Tuple of the selected (molId, confId) pairs, built on access (iterate self.selection instead) """
+        return tuple(self.selection)
+        
+    @idPaired.setter
+    def idPaired(self, molAndConfIds):
+        self.parseIds(molAndConfIds)
+        
+    def selectionText(self, limit = 20):
+        """ The first limit selected pairs as text, with the size of the selection if there are more """
+        pairs = []
+        for pair in self.selection:
+            if len(pairs) == limit:
+                return ', '.join(pairs) + ', ... (%d conformers of %d molecules)' % (
+                    len(self.selection), self.selection.NumMolecules())
+            pairs.append(str(pair))
+        return ', '.join(pairs)
         
         
     @property
     def selectedModels(self):
         """ Iterator over all selected models (molecules/conformations) """
-        for (molId, confId) in self.idPaired:
+        for (molId, confId) in self.selection:
             
             molData = self.ligandDict[molId]
             
-            if self.keyForParentMol in list(molData.keys()) and self.keyForMinimizedMol in list(molData.keys()):
+            if self.keyForParentMol in list(molData.keys()) and self.hasMinimizedConf(molData, confId):
                 
                 yield {self.keyForParentMol: 
-                       Chem.MolToMolBlock(molData[self.keyForParentMol], confId=confId),
+                       self.modelBlock(self.keyForParentMol, molId, confId),
                        
                        self.keyForMinimizedMol: 
-                       Chem.MolToMolBlock(molData[self.keyForMinimizedMol], confId=confId)
+                       self.modelBlock(self.keyForMinimizedMol, molId, confId)
                       }
             else:
                 
                 yield {self.keyForParentMol: 
-                       Chem.MolToMolBlock(molData[self.keyForParentMol], confId=confId)
+                       self.modelBlock(self.keyForParentMol, molId, confId)
                       }
+                
+    @property
+    def selectedModelKeys(self):
+        """ Iterator over (model category, molId, confId) of all selected models, nothing is serialized """
+        for (molId, confId) in self.selection:
             
+            yield (self.keyForParentMol, molId, confId)
+            
+            if self.hasMinimizedConf(self.ligandDict[molId], confId):
+                yield (self.keyForMinimizedMol, molId, confId)
+                
+    def modelVersion(self, modelCategory, molId, confId):
+        """ Version of the coordinates of one model, changes whenever MinimizeLigand rewrites them """
+        if modelCategory == self.keyForMinimizedMol:
+            minimized = self.ligandDict[molId][self.keyForMinimizedMol]
+            if isinstance(minimized, MinimizedConformers):
+                return minimized.GetVersion(confId)
+        return 0
+        
+    def modelBlock(self, modelCategory, molId, confId):
+        """ MolBlock of one model (parent or minimized conformer), served from a bounded LRU cache """
+        key = (molId, modelCategory, confId)
+        version = self.modelVersion(modelCategory, molId, confId)
+        
+        cached = self.blockCache.pop(key, None)
+        if cached is not None and cached[0] == version:
+            self.blockCacheHits += 1
+            block = cached[1]
+        else:
+            self.blockCacheMisses += 1
+            molData = self.ligandDict[molId]
+            if modelCategory == self.keyForMinimizedMol:
+                block = self.minimizedMolBlock(molData, confId)
+            elif confId == CONF_FRAMES:
+                block = self.framesBlock(molId)
+            else:
+                block = Chem.MolToMolBlock(molData[self.keyForParentMol], confId=confId)
+                
+        self.blockCache[key] = (version, block)
+        while len(self.blockCache) > self.blockCacheSize:
+            self.blockCache.popitem(last=False)
+            
+        return block
+        
+    def framesBlock(self, molId):
+        """ SDF block with every conformer of the parent molecule, one record per frame """
+        mol = self.ligandDict[molId][self.keyForParentMol]
+        return ''.join(Chem.MolToMolBlock(mol, confId=conf.GetId()) + '$$$$\n' for conf in mol.GetConformers())
+        
+    def frameIndex(self, molId, confId):
+        """ Index of the frame showing the conformer confId in framesBlock """
+        mol = self.ligandDict[molId][self.keyForParentMol]
+        return [conf.GetId() for conf in mol.GetConformers()].index(confId)
+        
+    def clearBlockCache(self):
+        """ Drop all cached MolBlocks (e.g. after editing parent molecules in place) """
+        self.blockCache = OrderedDict()
+            
+    def proteinBlock(self):
+        """ PDB block of the protein, serialized only once per protein and conformer """
+        key = (id(self.protein), self.proteinConfId)
+        
+        if key in self.proteinBlockCache:
+            self.proteinBlockStats['hits'] += 1
+            return self.proteinBlockCache[key]
+            
+        start = time.time()
+        pdb = Chem.MolToPDBBlock(self.protein, confId=self.proteinConfId)
+        self.proteinBlockStats['serializationTime'] = time.time() - start
+        self.proteinBlockStats['payloadBytes'] = len(pdb)
+        self.proteinBlockStats['misses'] += 1
+        
+        self.proteinBlockCache[key] = pdb
+        return pdb
+        
+    def proteinGrid(self):
+        """ Spatial index of the protein atoms, built once per protein and conformer """
+        key = (id(self.protein), self.proteinConfId)
+        if key not in self.proteinGridCache:
+            self.proteinGridCache[key] = ResidueGrid(self.protein, confId=self.proteinConfId)
+        return self.proteinGridCache[key]
+        
+    @property
+    def selectedCoordinates(self):
+        """ Coordinates of all atoms of the selected conformers (parent and minimized) as one array """
+        xyz = []
+        for (molId, confId) in self.selection:
+            molData = self.ligandDict[molId]
+            xyz.append(molData[self.keyForParentMol].GetConformer(confId).GetPositions())
+            if self.hasMinimizedConf(molData, confId):
+                minimized = molData[self.keyForMinimizedMol]
+                if isinstance(minimized, MinimizedConformers):
+                    xyz.append(minimized.GetPositions(confId))
+                else:
+                    xyz.append(minimized.GetConformer(confId).GetPositions())
+        if len(xyz) == 0:
+            return np.zeros((0, 3))
+        return np.concatenate(xyz)
+        
+    def pocketAtomIds(self, radius):
+        """ Ids of the protein atoms of all residues within radius of the selected conformers """
+        return tuple(self.proteinGrid().ResidueAtomsWithin(self.selectedCoordinates, radius))
+        
+    def pocketBlock(self, atomIds):
+        """ PDB block of the given protein atoms, cut out of the cached block of the whole protein """
+        if self.pocketBlockCache[0] == atomIds:
+            return self.pocketBlockCache[1]
+            
+        keep = set(atomIds)
+        serials = set()
+        lines = []
+        atomIdx = -1
+        for line in self.proteinBlock().splitlines():
+            record = line[:6]
+            if record in ('ATOM  ', 'HETATM'):
+                atomIdx += 1
+                if atomIdx in keep:
+                    lines.append(line)
+                    serials.add(line[6:11].strip())
+            elif record == 'CONECT':
+                bonded = [line[i:i + 5].strip() for i in range(6, len(line), 5)]
+                if all(serial in serials for serial in bonded if serial):
+                    lines.append(line)
+        lines.append('END')
+        
+        pdb = '\n'.join(lines) + '\n'
+        self.pocketBlockCache = (atomIds, pdb)
+        return pdb
+        
+    def adoptProteinCache(self, oldState):
+        """ Keep the serialized protein of a previous state if it holds the same protein """
+        if oldState is not None and oldState.protein is self.protein and self.protein is not None:
+            self.proteinConfId = oldState.proteinConfId
+            self.proteinBlockCache = oldState.proteinBlockCache
+            self.proteinBlockStats = oldState.proteinBlockStats
+            self.proteinGridCache = oldState.proteinGridCache
+            self.pocketBlockCache = oldState.pocketBlockCache
+            return True
+        return False
+        
+    def hasMinimizedConf(self, molData, confId):
+        """ Check whether a minimized version of the conformer exists """
+        if self.keyForMinimizedMol not in molData:
+            return False
+        minimized = molData[self.keyForMinimizedMol]
+        if isinstance(minimized, MinimizedConformers):
+            return confId in minimized
+        return True
+        
+    def minimizedMolBlock(self, molData, confId):
+        """ MolBlock of a minimized conformer (coordinate store or mol object) """
+        minimized = molData[self.keyForMinimizedMol]
+        if isinstance(minimized, MinimizedConformers):
+            return minimized.MolBlock(confId)
+        return Chem.MolToMolBlock(minimized, confId=confId)
+        
     @property
     def selectedMolNames(self):
         """ Return the names of all selected molecules """
-        return self.rdkit_mol_select
+        return self.selection.MolIds()
         
     @property
     def selectedConfIds(self):
-        """ Return the names of all selected confIds """
-        return self.rdkit_conf_select
+        """ Return the names of all selected confIds (of any selected molecule) """
+        if self.selection.NumMolecules() == 1:
+            return set(self.selection.ConfIds(list(self.selectedMolNames)[0]))
+        return set(confId for (molId, confId) in self.selection)
         
     @property
     def selectedMolecules(self):
@@ -269,21 +1590,70 @@ class MolViewState(object):
     @property
     def allConfIds(self):
         """ Return the number of conformations - use the first selected molecule to determine """
-        nconfIds = self.selectedMolecules[0].GetNumConformers()
+        nconfIds = self.numConformers(next(iter(self.selectedMolNames)))
         return list(range(nconfIds))
         
+    def numConformers(self, molId):
+        """ Return the number of conformers of a molecule (from the index of a lazy library) """
+        if isinstance(self.ligandDict, LazyLigandLibrary):
+            return self.ligandDict.NumConformers(molId)
+        return self.ligandDict[molId][self.keyForParentMol].GetNumConformers()
+        
+    def propNames(self, molId):
+        """ Return the sorted names of all properties available for a molecule """
+        mol = self.ligandDict[molId][self.keyForParentMol]
+        names = set(mol.GetPropNames())
+        if self.descriptorTable is not None and molId in self.descriptorTable:
+            names.update(self.descriptorTable.descriptors)
+        names.update(PROP_RDKIT)
+        return tuple(sorted(names))
+        
+    def getProperty(self, molId, prop):
+        """ Return one property of a molecule; RDKit descriptors missing from the mol and the 
+        descriptor table are calculated on first access and memoized (bounded, LRU eviction) """
+        mol = self.ligandDict[molId][self.keyForParentMol]
+        
+        if mol.HasProp(prop):
+            return mol.GetProp(prop)
+            
+        if self.descriptorTable is not None and molId in self.descriptorTable \
+                and prop in self.descriptorTable.descriptorIndex:
+            return self.descriptorTable.GetValue(molId, prop)
+            
+        if prop not in _DESCRIPTOR_FUNCS:
+            raise KeyError(prop)
+            
+        key = (molId, prop)
+        if key in self.propCache:
+            value = self.propCache.pop(key)
+        else:
+            value = _CalcDescriptors(mol, (prop,))[0]
+        self.propCache[key] = value
+        
+        while len(self.propCache) > self.propCacheSize:
+            self.propCache.popitem(last=False)
+            
+        return value
+        
+    def prefetchProperty(self, molIds, prop):
+        """ Calculate one property for several molecules ahead of their selection """
+        for molId in molIds:
+            if molId in self.ligandDict:
+                self.getProperty(molId, prop)
+                
     @property
     def getPropPrecalculated(self):
-        """ Return the precalculated properties """
+        """ Return the properties of the selected molecule as a lazy mapping """
         if len(self.selectedMolNames) != 1:
             return None
         else:
-            mol = self.ligandDict[list(self.selectedMolNames)[0]][self.keyForParentMol]
-             
-            if len(mol.GetPropNames()) == 0:
+            molId = list(self.selectedMolNames)[0]
+            props = LazyProperties(self, molId)
+            
+            if len(props) == 0:
                 return 'Not found'
             else:
-                return {prop: mol.GetProp(prop) for prop in mol.GetPropNames()}
+                return props
                 
     @property
     def getMinimizationEnergy(self):
@@ -323,6 +1693,101 @@ class MolViewState(object):
             
         
         
+class RenderProfiler(object):
+    """ Wall time per stage and bytes sent per model of every render3D call, the last historySize 
+    renders are kept. A disabled profiler does not time anything """
+    
+    def __init__(self, enabled = True, historySize = 100):
+        self.enabled = enabled
+        self.history = deque(maxlen = historySize)
+        self.current = None
+        self.nRenders = 0
+        
+    def Start(self):
+        """ Begin the record of a render """
+        if self.enabled:
+            self.nRenders += 1
+            self.current = {'render': self.nRenders, 'start': time.time(), 
+                            'stages': OrderedDict(), 'payloads': []}
+            
+    def Finish(self):
+        """ Close the record of the current render and add it to the history """
+        if self.enabled and self.current is not None:
+            self.current['total'] = time.time() - self.current.pop('start')
+            self.history.append(self.current)
+            self.current = None
+            
+    @contextmanager
+    def Stage(self, name):
+        """ Adds the wall time of the block to the stage (a stage can be entered several times per render) """
+        if not self.enabled or self.current is None:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            stages = self.current['stages']
+            stages[name] = stages.get(name, 0.0) + time.time() - start
+            
+    def AddPayload(self, modelKey, data):
+        """ Records the size of the molecule data sent for one model """
+        if self.enabled and self.current is not None:
+            self.current['payloads'].append((modelKey, len(data)))
+            
+    def StageNames(self):
+        """ Names of all stages in the history, in order of first appearance """
+        names = OrderedDict()
+        for record in self.history:
+            for name in record['stages']:
+                names[name] = None
+        return list(names)
+        
+    def Rows(self):
+        """ One row per render: render number, total time, time of every stage, models sent, bytes sent """
+        stageNames = self.StageNames()
+        header = ['render', 'total'] + stageNames + ['models', 'bytes']
+        rows = []
+        for record in self.history:
+            row = [record['render'], record['total']]
+            row.extend(record['stages'].get(name, 0.0) for name in stageNames)
+            row.append(len(record['payloads']))
+            row.append(sum(nBytes for _, nBytes in record['payloads']))
+            rows.append(row)
+        return header, rows
+        
+    def Table(self):
+        """ History as a text table, times in milliseconds """
+        header, rows = self.Rows()
+        lines = [''.join('%12s' % name for name in header)]
+        for row in rows:
+            cells = ['%12d' % row[0]]
+            cells.extend('%12.2f' % (1000 * value) for value in row[1:-2])
+            cells.extend('%12d' % value for value in row[-2:])
+            lines.append(''.join(cells))
+        return '\n'.join(lines)
+        
+    def ToCSV(self, path, payloads = False):
+        """ Writes the history to a CSV file (one row per render, or per model sent if payloads) """
+        import csv
+        with open(path, 'w') as f:
+            writer = csv.writer(f)
+            if payloads:
+                writer.writerow(['render', 'model', 'molId', 'confId', 'bytes'])
+                for record in self.history:
+                    for (modelKey, nBytes) in record['payloads']:
+                        writer.writerow([record['render']] + list(modelKey) + [nBytes])
+            else:
+                header, rows = self.Rows()
+                writer.writerow(header)
+                writer.writerows(rows)
+                
+    def Clear(self):
+        """ Drops the history """
+        self.history.clear()
+        self.nRenders = 0
+        
+        
 class MolView3D(object):
     
     def __init__(self, 
@@ -334,8 +1799,32 @@ class MolView3D(object):
                  stylePanel = None, 
                  labelPanel = False,
                  propertyPanel = False,
-                 emPanel = False):
-        """This function initiates required widgets and 3Dmol.js viewer"""
+                 emPanel = False,
+                 descriptorTable = None,
+                 propPrefetch = 0,
+                 pocketRadius = None,
+                 confAnimation = False,
+                 confAnimationInterval = 200,
+                 debounceTime = 0,
+                 profile = False,
+                 clusterPanel = False,
+                 clusterDataKey = 'clusters'):
+        """This function initiates required widgets and 3Dmol.js viewer
+        
+        pocketRadius (in angstrom) switches on pocket mode: only the protein residues within that 
+        distance of the selected ligand conformers are sent to the viewer
+        
+        confAnimation sends all conformers of a single selected molecule once as frames of one model; 
+        switching conformers (or playing them, every confAnimationInterval ms) then only sends a frame index
+        
+        debounceTime (in seconds) collects widget changes arriving within that window into one render; the
+        selection itself follows every change
+        
+        profile records the time of every stage of render3D and the bytes sent per model in self.profiler
+        
+        clusterPanel adds options to show only the cluster representatives of the selected conformers 
+        (clusters stored under clusterDataKey by ClusterConformers) and to expand the cluster of confId
+        """
         
         if ligSelPanel not in ('full', 'minimal'):
             raise KeyError('ligSelPanel can be full or minimal')
@@ -356,6 +1845,25 @@ class MolView3D(object):
         self.stylePanel = stylePanel
         self.labelPanel = labelPanel
         self.emPanel = emPanel
+        self.propPrefetch = propPrefetch
+        self.pocketRadius = pocketRadius
+        self.pocketAtomIds = None
+        self.confAnimation = confAnimation
+        self.clusterPanel = clusterPanel
+        self.clusterDataKey = clusterDataKey
+        self.confAnimationInterval = confAnimationInterval
+        self.animating = False
+        
+        if debounceTime > 0 and not _canDebounce:
+            raise ImportError("debounceTime requires tornado")
+        self.debounceTime = debounceTime
+        # widget changes made by the viewer itself are not user actions and don't trigger a render
+        self.suppressEvents = False
+        self.pendingRender = None
+        self.eventCount = 0
+        self.suppressedEventCount = 0
+        self.renderCount = 0
+        self.profiler = RenderProfiler(enabled = profile)
         
         
         # Right hand panel (widgets)
@@ -400,10 +1908,18 @@ class MolView3D(object):
         # Rendering left (molecule viewer) and right (all widgets) panels
         self.RenderWidgetsWithViewer()
         
+        # models currently in the viewer {modelKey: {'id': model id, 'style': style, 'version': version}}
+        self.sceneModels = OrderedDict()
+        self.nextModelId = 0
+        # surfaces currently in the viewer {modelKey: {'id': surface id, 'model': model id, 'type': surface type}}
+        self.sceneSurfaces = {}
+        self.surfaceRebuilds = 0
+        self.totalSurfaceRebuilds = 0
+        
         # adding model to viewer
         self.SetMolData(ligandDict, protein, 
                         keyForParentMol, keyForMinimizedMol, energyDataKey, 
-                        molAndConfIds = None)
+                        molAndConfIds = None, descriptorTable = descriptorTable)
         
                  
         
@@ -439,6 +1955,18 @@ class MolView3D(object):
             self.wgBox.append(Box([Label(value='confId'),self.confId], layout=self.itemLayout))
             self.widgetsFor3DView.extend(['molId', 'confId'])
             
+        if self.clusterPanel:
+            self.clusterReps = Checkbox(description='clusterReps', value=False)
+            self.expandCluster = Checkbox(description='expandCluster', value=False)
+            box_for_clusters = HBox([self.clusterReps, self.expandCluster])
+            self.wgBox.append(Box([Label(value=''), box_for_clusters], layout=self.itemLayout))
+            self.widgetsFor3DView.extend(['clusterReps', 'expandCluster'])
+            
+        if self.confAnimation:
+            self.confPlay = Checkbox(description='playConformers', value=False)
+            self.wgBox.append(Box([Label(value=''),self.confPlay], layout=self.itemLayout))
+            self.widgetsFor3DView.append('confPlay')
+            
     def MoleculeVisibilityPanelUI(self):
         """ligand, protein, and energy minimized ligand visibility widgets"""
         self.ligandVisible = Checkbox(description='ligandVisible', value=True)
@@ -579,10 +2107,11 @@ class MolView3D(object):
                    keyForParentMol = 'parent', 
                    keyForMinimizedMol = 'minimized',
                    energyDataKey = 'energy',
-                   molAndConfIds = None):
+                   molAndConfIds = None,
+                   descriptorTable = None):
         """This function sets ligand dictionary, protein, and dict keys and initiates MolViewState class"""
         
-        if isinstance(ligandDict, dict) is False:
+        if isinstance(ligandDict, Mapping) is False:
             raise TypeError("ligandDict must be dict")
             
         if all(isinstance(key, str if PY3 else basestring) for key in ligandDict.keys()) is False:
@@ -593,26 +2122,77 @@ class MolView3D(object):
         self.keyForMinimizedMol = keyForMinimizedMol
         self.energyDataKey = energyDataKey
         
+        oldState = self.__dict__.get('molViewState')
+        
         self.molViewState = MolViewState(ligandDict, protein, 
-                                         keyForParentMol, keyForMinimizedMol, energyDataKey)
+                                         keyForParentMol, keyForMinimizedMol, energyDataKey,
+                                         descriptorTable)
+        
+        # the serialized protein and its model in the viewer are only dropped for a new protein
+        sameProtein = self.molViewState.adoptProteinCache(oldState)
+        
+        if len(self.sceneModels) > 0:
+            self.ClearScene(keepProtein = sameProtein)
         
         if self.molViewState.ligandDict is not None:
             
             keys = list(self.molViewState.ligandDict.keys())
             self.onStartIds = ((keys[0], 0),)
             
-            self.molId.options = keys
-            self.molId.value = keys[0]
-            self.confId.options = list(range(9))
-            self.confId.value=0
+            self.suppressEvents = True
+            try:
+                self.molId.options = keys
+                self.molId.value = keys[0]
+                self.SetConfIdOptions(list(range(self.molViewState.numConformers(keys[0]))))
+                self.confId.value=0
+            finally:
+                self.suppressEvents = False
             
             self.selectedMolsConfsView.value = ', '.join([str(x) for x in self.onStartIds])
             
+            # one render for the new data, the widget changes above are suppressed
+            self.onStart = True
+            self.SelectMolAndConf()
+            
     
     def handle_change(self, change):
         """This function handles all the interactive widgets except buttons and 3Dmol.js viewer"""
+        self.eventCount += 1
         
-        self.SelectMolAndConf()
+        if self.suppressEvents:
+            # widget value set by SelectMolAndConf/SetMolData, not by the user
+            self.suppressedEventCount += 1
+            return
+            
+        if self.debounceTime > 0:
+            # the selection grows with every change in multi mode, so it is updated for each of them;
+            # only the render waits, restarting the window so that the last change of a burst renders
+            self.UpdateSelection()
+            loop = IOLoop.current()
+            if self.pendingRender is not None:
+                loop.remove_timeout(self.pendingRender)
+                self.suppressedEventCount += 1
+            self.pendingRender = loop.call_later(self.debounceTime, self.FlushPendingChange)
+        else:
+            self.SelectMolAndConf()
+            
+    def FlushPendingChange(self):
+        """ Renders the debounced widget changes """
+        self.pendingRender = None
+        self.render3D()
+        
+    def SelectClusters(self):
+        """ Narrows the selection down to cluster representatives if clusterReps is ticked """
+        if self.clusterPanel and self.clusterReps.value:
+            expand = self.expandCluster.value
+            self.molViewState.selectClusterRepresentatives(self.clusterDataKey, 
+                                                           self.molId.value if expand else None,
+                                                           self.confId.value if expand else None)
+            
+    def SetConfIdOptions(self, options):
+        """ Assigns the confId dropdown options only if they changed (assigning fires change events) """
+        if list(self.confId.options) != list(options):
+            self.confId.options = options
         
     
     def handle_zoomTo_button(self, b):
@@ -623,60 +2203,68 @@ class MolView3D(object):
     
     def SelectMolAndConf(self, molAndConfIds = None):
         """ instantiates mol and conformer selection function of the MolViewState"""
+        self.UpdateSelection(molAndConfIds)
+        self.render3D()
+        
+    def UpdateSelection(self, molAndConfIds = None):
+        """ Updates the selection of the MolViewState from the widgets (or molAndConfIds) without rendering """
         if self.molViewState.ligandDict is None:
             raise TypeError("please provide ligandDict before selection")
         
         if self.onStart:
             molAndConfIds = self.onStartIds
         
-        if molAndConfIds is None and self.ligSelPanel == 'full':
-            
-            self.molViewState.selectMolecules(self.selectAllMols.value, 
-                                              self.selectMultiMols.value,
-                                              self.molId.value)
+        # the widget values set here must not trigger more renders
+        self.suppressEvents = True
+        try:
+            if molAndConfIds is None and self.ligSelPanel == 'full':
             
-            self.molViewState.selectConformations(self.selectAllConfs.value, 
-                                                  self.selectMultiConfs.value,
-                                                  self.confId.value)
+                self.molViewState.selectMolecules(self.selectAllMols.value, 
+                                                  self.selectMultiMols.value,
+                                                  self.molId.value)
             
-            self.molViewState.generateIds()
+                self.molViewState.selectConformations(self.selectAllConfs.value, 
+                                                      self.selectMultiConfs.value,
+                                                      self.confId.value)
+                self.SelectClusters()
             
-            self.confId.options = self.molViewState.allConfIds
+                self.SetConfIdOptions(self.molViewState.allConfIds)
             
-            self.selectedMolsConfsView.value = ', '.join([str(x) for x in self.molViewState.idPaired])
+                self.selectedMolsConfsView.value = self.molViewState.selectionText()
             
-        elif molAndConfIds is None and self.ligSelPanel == 'minimal':
+            elif molAndConfIds is None and self.ligSelPanel == 'minimal':
             
-            self.molViewState.selectMolecules(False, False, self.molId.value)
-            self.molViewState.selectConformations(False, False, self.confId.value)
+                self.molViewState.selectMolecules(False, False, self.molId.value)
+                self.molViewState.selectConformations(False, False, self.confId.value)
+                self.SelectClusters()
             
-            self.molViewState.generateIds()
+                self.SetConfIdOptions(self.molViewState.allConfIds)
             
-            self.confId.options = self.molViewState.allConfIds
+                self.selectedMolsConfsView.value = self.molViewState.selectionText()
             
-            self.selectedMolsConfsView.value = ', '.join([str(x) for x in self.molViewState.idPaired])
-            
-        else:
-            self.molViewState.parseIds(molAndConfIds = molAndConfIds)
+            else:
+                self.molViewState.parseIds(molAndConfIds = molAndConfIds)
             
-            if self.ligSelPanel == 'full' and len(self.molViewState.selectedMolNames) > 1:
-                self.selectMultiMols.value = True
-            if self.ligSelPanel == 'full' and len(self.molViewState.selectedConfIds) > 1:
-                self.selectMultiConfs.value = True
+                if self.ligSelPanel == 'full' and len(self.molViewState.selectedMolNames) > 1:
+                    self.selectMultiMols.value = True
+                if self.ligSelPanel == 'full' and len(self.molViewState.selectedConfIds) > 1:
+                    self.selectMultiConfs.value = True
                 
-            #For multiple molecules with unequal number of conformers, it is hard to determine acceptable confIds
-            self.confId.options = self.molViewState.allConfIds
+                #For multiple molecules with unequal number of conformers, it is hard to determine acceptable confIds
+                self.SetConfIdOptions(self.molViewState.allConfIds)
             
-            self.selectedMolsConfsView.value = ', '.join([str(x) for x in self.molViewState.idPaired])
-            
-        self.render3D()
+                self.selectedMolsConfsView.value = self.molViewState.selectionText()
+        finally:
+            self.suppressEvents = False
         
         
     def ShowLigandProperty(self):
         """ Handles property in render3D function """
         preCalcProp = self.molViewState.getPropPrecalculated
-        if isinstance(preCalcProp, dict):
-            self.prop_wg.options = sorted(list(preCalcProp.keys()))
+        if isinstance(preCalcProp, Mapping):
+            propNames = list(preCalcProp.keys())
+            if list(self.prop_wg.options) != propNames:
+                self.prop_wg.options = propNames
             prop=self.prop_wg.value
             self.prop_view.value = prop + ' : ' + str(preCalcProp[prop])
         elif preCalcProp == 'Not found':
@@ -684,6 +2272,15 @@ class MolView3D(object):
         else:
             self.prop_view.value = 'single molecule selection required!'
             
+    def PrefetchLigandProperty(self):
+        """ Calculates the selected property for the neighbours of the selected molecule in the molId dropdown """
+        if len(self.molViewState.selectedMolNames) != 1 or self.prop_wg.value not in PROP_RDKIT:
+            return
+        molIds = list(self.molId.options)
+        pos = molIds.index(list(self.molViewState.selectedMolNames)[0])
+        neighbours = molIds[max(pos - self.propPrefetch, 0):pos] + molIds[pos + 1:pos + 1 + self.propPrefetch]
+        self.molViewState.prefetchProperty(neighbours, self.prop_wg.value)
+        
     def ShowMinimizationEnergy(self):
         """ Handles energy minimization data in render3D function """
         energy = self.molViewState.getMinimizationEnergy
@@ -691,7 +2288,11 @@ class MolView3D(object):
         confId = self.confId.value
         
         if isinstance(energy, dict) and confId in energy:
-            self.energy_wg.value = 'minimization data ('+ energyDataKey +') : ' + str(energy[confId])
+            text = 'minimization data ('+ energyDataKey +') : ' + str(energy[confId])
+            if energy[confId] is not None:
+                minimum = min(value for value in energy.values() if value is not None)
+                text += ', above minimum : %.2f' % (energy[confId] - minimum)
+            self.energy_wg.value = text
         elif isinstance(energy, dict) and confId not in energy:
             self.energy_wg.value = 'data not found'
         elif energy is None:
@@ -699,8 +2300,8 @@ class MolView3D(object):
         else:
             self.energy_wg.value = 'data not found'
             
-    def AddLigandStyle(self, modelCategory, modelId):
-        """ Handles ligand and energy minimized ligand drawing style and color in AddLigandWithStyle function """
+    def LigandStyle(self, modelCategory):
+        """ Returns (drawing style, color scheme) of ligand or energy minimized ligand """
         
         if modelCategory == self.keyForParentMol:
             
@@ -712,9 +2313,16 @@ class MolView3D(object):
             color = self.emColorScheme.value if 'emColorScheme' in self.__dict__ else 'whiteCarbon'
             self.emLigStyle = ligStyle
             
-            
+        return (ligStyle, color)
+        
+    def AddLigandStyle(self, modelId, style):
+        """ Handles ligand and energy minimized ligand drawing style and color (surfaces are added in UpdateSurfaces) """
+        
+        ligStyle, color = style
+        
         if ligStyle == 'surface':
-            self.view.addSurface('SES', {'model':modelId});
+            # atoms drawn as freshly added models
+            self.view.setStyle({'model':modelId},{'line':{}});
         elif ligStyle == 'ballstick':
             self.view.setStyle({'model':modelId},{'stick':{'radius':'0.2','colorscheme': color},
                                                   'sphere':{'radius':'0.4', 'colorscheme': color}
@@ -743,99 +2351,271 @@ class MolView3D(object):
                                               })
     
     
-    def AddProteinStyle(self):
-        """ Handles protein drawing style in AddProteinWithStyle function """
+    def ProteinStyle(self):
+        """ Returns (drawing style, helicesAsTubes) of protein """
         # 'protStyle_wg' and 'protStyle_helicesAsTubes_wg' rendered as pair
         self.protStyle = self.protStyle_wg.value if 'protStyle_wg' in self.__dict__ else self.protStyle
+        tubes = self.protStyle_helicesAsTubes_wg.value if 'protStyle_helicesAsTubes_wg' in self.__dict__ else False
+        return (self.protStyle, tubes)
+        
+    def AddProteinStyle(self, modelId, style):
+        """ Handles protein drawing style (surfaces are added in UpdateSurfaces) """
+        protStyle, tubes = style
         
-        if self.protStyle == 'surface':
-            self.view.addSurface('SES', {'model': self.proteinModelId});
+        if protStyle == 'hidden':
+            self.view.setStyle({'model': modelId},{});
+            
+        elif protStyle == 'surface':
+            self.view.setStyle({'model': modelId},{'line':{}});
             
-        elif self.protStyle == 'line':
-            self.view.setStyle({'model': self.proteinModelId},{'line':{}});
+        elif protStyle == 'line':
+            self.view.setStyle({'model': modelId},{'line':{}});
             
-        elif self.protStyle == 'cartoon' and 'protStyle_helicesAsTubes_wg' not in self.__dict__:
-            self.view.setStyle({'model': self.proteinModelId},{'cartoon':{'color': 'spectrum', 
-                                                                          'arrows': 'true'}
-                                                              })
+        elif tubes:
+            self.view.setStyle({'model': modelId},{'cartoon':{'color': 'spectrum',
+                                                              'arrows': 'true', 
+                                                              'tubes' : 'true'}
+                                                  })
         else:
-            if self.protStyle_helicesAsTubes_wg.value:
-                self.view.setStyle({'model': self.proteinModelId},{'cartoon':{'color': 'spectrum',
-                                                                              'arrows': 'true', 
-                                                                              'tubes' : 'true'}
-                                                                  })
-            else:
-                self.view.setStyle({'model': self.proteinModelId},{'cartoon':{'color': 'spectrum', 
-                                                                              'arrows': 'true'}
-                                                                  })
-                
+            self.view.setStyle({'model': modelId},{'cartoon':{'color': 'spectrum', 
+                                                              'arrows': 'true'}
+                                                  })
+            
     
-    def AddLigandWithStyle(self):
-        """ add ligand and energy minimized ligand in viewer (called in render3D function) """
+    def AddLigandWithStyle(self, scene):
+        """ add ligand and energy minimized ligand to the scene (called in render3D function) """
+        
+        ligandVisible = 'ligandVisible' in self.__dict__ and self.ligandVisible.value
+        emLigandVisible = 'emLigandVisible' in self.__dict__ and self.emLigandVisible.value
         
-        self.modelId = -1
+        styles = {self.keyForParentMol: self.LigandStyle(self.keyForParentMol),
+                  self.keyForMinimizedMol: self.LigandStyle(self.keyForMinimizedMol)}
+        
+        animatedMolId = self.AnimatedMolId()
         
         # add models (ligands)
-        if 'ligandVisible' in self.__dict__ and self.ligandVisible.value:
+        if ligandVisible or emLigandVisible:
+            for modelKey in self.molViewState.selectedModelKeys:
+                if modelKey[0] == self.keyForParentMol and ligandVisible and modelKey[1] == animatedMolId:
+                    # one model with all conformers as frames
+                    scene[(self.keyForParentMol, animatedMolId, CONF_FRAMES)] = styles[self.keyForParentMol]
+                elif modelKey[0] == self.keyForParentMol and ligandVisible:
+                    scene[modelKey] = styles[self.keyForParentMol]
+                elif modelKey[0] == self.keyForMinimizedMol and emLigandVisible:
+                    scene[modelKey] = styles[self.keyForMinimizedMol]
+                    
+    def AnimatedMolId(self):
+        """ molId shown as a multi-frame model (conformer animation mode with a single molecule selected, 
+        and a single conformer or playback on); an overlay of several conformers keeps one model each """
+        if self.confAnimation and len(self.molViewState.selectedMolNames) == 1:
+            play = 'confPlay' in self.__dict__ and self.confPlay.value
+            if play or len(self.molViewState.selectedConfIds) == 1:
+                return list(self.molViewState.selectedMolNames)[0]
+        return None
+        
+    def UpdateAnimation(self):
+        """ Shows the frame of the selected conformer or plays all frames, done in the viewer """
+        animatedMolId = self.AnimatedMolId()
+        play = animatedMolId is not None and self.confPlay.value
+        
+        if play != self.animating:
+            if play:
+                self.view.animate({'loop': 'forward', 'interval': self.confAnimationInterval})
+            else:
+                self.view.stopAnimate()
+            self.animating = play
+            
+        if animatedMolId is not None and not play:
+            confId = min(self.molViewState.selectedConfIds)
+            self.view.setFrame(self.molViewState.frameIndex(animatedMolId, confId))
             
-            for models in self.molViewState.selectedModels:
+    def AddProteinWithStyle(self, scene):
+        """ add protein to the scene (called in render3D function) """
+        if self.molViewState.protein is not None:
+            visible = 'proteinVisible' in self.__dict__ and self.proteinVisible.value
+            if visible and self.pocketRadius is not None:
+                # pocket changes only if the residue set around the selection changes
+                pocketAtomIds = self.molViewState.pocketAtomIds(self.pocketRadius)
+                if len(pocketAtomIds) > 0:
+                    self.pocketAtomIds = pocketAtomIds
+                else:
+                    # nothing around the selection: hide the protein rather than send all of it
+                    visible = False
+            if visible:
+                scene[PROTEIN_MODEL_KEY] = self.ProteinStyle()
+            elif PROTEIN_MODEL_KEY in self.sceneModels:
+                # hide rather than remove, showing it again does not resend the protein
+                scene[PROTEIN_MODEL_KEY] = ('hidden', False)
                 
-                if self.keyForParentMol in list(models.keys()):
-                    self.view.addModel(models[self.keyForParentMol], 'sdf')
-                    self.modelId = self.modelId + 1
-                    self.AddLigandStyle(self.keyForParentMol, self.modelId)
-                    
+    def SceneForSelection(self):
+        """ Returns {modelKey: style} of every model that should be in the viewer for the current state 
+        (modelKey is (model category, molId, confId)) """
+        scene = OrderedDict()
+        self.AddLigandWithStyle(scene)
+        self.AddProteinWithStyle(scene)
+        return scene
+        
+    def AddModelToViewer(self, modelKey):
+        """ Sends one model to the viewer and returns its model id """
+        if modelKey == PROTEIN_MODEL_KEY:
+            with self.profiler.Stage('pdbBlock'):
+                if self.pocketAtomIds is not None:
+                    pdb = self.molViewState.pocketBlock(self.pocketAtomIds)
+                else:
+                    pdb = self.molViewState.proteinBlock()
+            with self.profiler.Stage('addModel'):
+                self.view.addModel(pdb,'pdb')
+            self.profiler.AddPayload(modelKey, pdb)
+            self.proteinModelId = self.nextModelId
+        else:
+            with self.profiler.Stage('molBlock'):
+                block = self.molViewState.modelBlock(*modelKey)
+            with self.profiler.Stage('addModel'):
+                if modelKey[2] == CONF_FRAMES:
+                    self.view.addModelsAsFrames(block, 'sdf')
+                else:
+                    self.view.addModel(block, 'sdf')
+            self.profiler.AddPayload(modelKey, block)
+        # 3Dmol.js numbers models in the order they are added, removed models keep their number
+        modelId = self.nextModelId
+        self.nextModelId = self.nextModelId + 1
+        return modelId
+        
+    def UpdateScene(self, scene):
+        """ Brings the viewer to the given scene: models that are not needed anymore are removed, new ones 
+        added and the remaining ones only restyled if their style changed """
+        
+        for modelKey in list(self.sceneModels.keys()):
+            if modelKey not in scene:
+                self.view.removeModel(self.sceneModels.pop(modelKey)['id'])
                 
-        if 'emLigandVisible' in self.__dict__ and self.emLigandVisible.value:
+        for modelKey, style in scene.items():
             
-            for models in self.molViewState.selectedModels:
+            if modelKey == PROTEIN_MODEL_KEY:
+                version = self.pocketAtomIds
+            else:
+                version = self.molViewState.modelVersion(*modelKey)
+            
+            if modelKey in self.sceneModels and self.sceneModels[modelKey]['version'] != version:
+                # coordinates were rewritten (e.g. minimized again) since the model was sent
+                self.view.removeModel(self.sceneModels.pop(modelKey)['id'])
                 
-                if self.keyForMinimizedMol in list(models.keys()):
-                    self.view.addModel(models[self.keyForMinimizedMol], 'sdf')
-                    self.modelId = self.modelId + 1
-                    self.AddLigandStyle(self.keyForMinimizedMol, self.modelId)
-                    
-        
-        
-    def AddProteinWithStyle(self):
-        """ add protein in viewer (called in render3D function) """
-        if self.molViewState.protein is not None:
-            if 'proteinVisible' in self.__dict__ and self.proteinVisible.value:
-                pdb = Chem.MolToPDBBlock(self.molViewState.protein)
-                self.view.addModel(pdb,'pdb')
-                self.proteinModelId = self.modelId + 1
-                self.AddProteinStyle()
+            if modelKey in self.sceneModels:
+                model = self.sceneModels[modelKey]
+                if model['style'] == style:
+                    continue
+            else:
+                model = {'id': self.AddModelToViewer(modelKey), 'style': None, 'version': version}
+                self.sceneModels[modelKey] = model
                 
-    
-    def render3D(self):
-        """ This function updates the 3DMol.js viewer"""
+            with self.profiler.Stage('style'):
+                if modelKey == PROTEIN_MODEL_KEY:
+                    self.AddProteinStyle(model['id'], style)
+                else:
+                    self.AddLigandStyle(model['id'], style)
+            model['style'] = style
+            
+        with self.profiler.Stage('surfaces'):
+            self.UpdateSurfaces()
+        
+    def NextSurfaceId(self):
+        """ Id 3Dmol.js gives to the next surface (one more than the largest id in use) """
+        return max([surface['id'] for surface in self.sceneSurfaces.values()] + [0]) + 1
+        
+    def UpdateSurfaces(self):
+        """ Keeps the SES surfaces of the models drawn as surface; a surface is only removed or computed 
+        again if its model was replaced or its style changed (counted in surfaceRebuilds) """
+        wanted = {}
+        for modelKey, model in self.sceneModels.items():
+            if model['style'][0] == 'surface':
+                wanted[modelKey] = {'model': model['id'], 'type': 'SES'}
+                
+        for modelKey in list(self.sceneSurfaces.keys()):
+            surface = self.sceneSurfaces[modelKey]
+            if modelKey not in wanted or wanted[modelKey]['model'] != surface['model'] \
+                    or wanted[modelKey]['type'] != surface['type']:
+                self.view.removeSurface(self.sceneSurfaces.pop(modelKey)['id'])
+                
+        self.surfaceRebuilds = 0
+        for modelKey, surface in wanted.items():
+            if modelKey not in self.sceneSurfaces:
+                surface['id'] = self.NextSurfaceId()
+                self.view.addSurface(surface['type'], {'model': surface['model']});
+                self.sceneSurfaces[modelKey] = surface
+                self.surfaceRebuilds += 1
+                
+        self.totalSurfaceRebuilds += self.surfaceRebuilds
+        
+    def ClearScene(self, keepProtein = False):
+        """ Removes everything (but the protein model, if keepProtein) from the viewer """
         self.view.removeAllLabels()
-        self.view.removeAllModels()
         self.view.removeAllSurfaces()
+        self.sceneSurfaces = {}
+        
+        if keepProtein and PROTEIN_MODEL_KEY in self.sceneModels:
+            for modelKey in list(self.sceneModels.keys()):
+                if modelKey != PROTEIN_MODEL_KEY:
+                    self.view.removeModel(self.sceneModels.pop(modelKey)['id'])
+            # style is applied again (with its surface) on the next render
+            self.sceneModels[PROTEIN_MODEL_KEY]['style'] = None
+        else:
+            self.view.removeAllModels()
+            self.sceneModels = OrderedDict()
+            self.nextModelId = 0
+        
+        
+    def render3D(self):
+        """ This function updates the 3DMol.js viewer, sending only the models that changed since the last call"""
+        self.renderCount += 1
+        self.profiler.Start()
+        
+        with self.profiler.Stage('labels'):
+            self.view.removeAllLabels()
         
         self.view.setBackgroundColor(self.background.value)
         
-        self.AddLigandWithStyle()
+        with self.profiler.Stage('selection'):
+            scene = self.SceneForSelection()
+            
+        # stages of the models (molBlock, pdbBlock, addModel, style, surfaces) are recorded inside
+        self.UpdateScene(scene)
         
+        if self.confAnimation:
+            with self.profiler.Stage('animation'):
+                self.UpdateAnimation()
+            
         # add label if required
         if self.labelPanel:
             if 'ligandVisible' in self.__dict__ and self.ligandVisible.value:
-                self.AddLigandLabels()
+                with self.profiler.Stage('labels'):
+                    self.AddLigandLabels()
                 
-        self.AddProteinWithStyle()
         
         # zoomTo does not work well for surface and label... so, zoomTo should not be default settings
         if self.onStart:
             self.view.zoomTo()
             self.onStart = False
             
-        if self.propertyPanel:
-            self.ShowLigandProperty()
+        # panel widgets are observed too, writing them must not start another render
+        self.suppressEvents = True
+        try:
+            with self.profiler.Stage('panels'):
+                if self.propertyPanel:
+                    self.ShowLigandProperty()
+                    
+                if self.emPanel:
+                    self.ShowMinimizationEnergy()
+        finally:
+            self.suppressEvents = False
             
-        if self.emPanel:
-            self.ShowMinimizationEnergy()
+        with self.profiler.Stage('display'):
+            display(self.view.update())
             
-        display(self.view.update())
+        self.profiler.Finish()
+        
+        # after the update, so that prefetching does not delay the current view
+        if self.propertyPanel and self.propPrefetch > 0:
+            self.PrefetchLigandProperty()
         
         
         
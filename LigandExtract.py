@@ -1,51 +1,197 @@
 """Ligand Extraction from mol object (RDKit PDB file reader should be used in mol object generation)
-Originally written by Greg Landrum and updated by Malitha Humayun Kabir as a part of GSoC 2017 
+Originally written by Greg Landrum and updated by Malitha Humayun Kabir as a part of GSoC 2017
 Project : RDKit - 3Dmol.js integration
 Mentors: Paul Czodrowski and Greg Landrum
 Date: 28th July 2017
 Email# malitha12345@gmail.com
 """
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from rdkit import Chem
+from rdkit.Geometry import Point3D
+import numpy as np
+import time
+import os
+
+WATER_RESIDUES = ('HOH', 'WAT', 'DOD', 'H2O')
+
+## Residue index
+
+ResidueKey = namedtuple('ResidueKey', ('chain', 'resName', 'resNum'))
+
+class ResidueIndex(object):
+    """residues of a mol object created from pdb file: (chain, resName, resNum) -> atom ids, built in one pass"""
+
+    def __init__(self, mol):
+        self.atomIds = OrderedDict()
+        self.hetero = set()
+        for atom in mol.GetAtoms():
+            info = atom.GetPDBResidueInfo()
+            if info is None:
+                continue
+            key = ResidueKey(info.GetChainId().strip(), info.GetResidueName().strip(), info.GetResidueNumber())
+            self.atomIds.setdefault(key, []).append(atom.GetIdx())
+            if info.GetIsHeteroAtom():
+                self.hetero.add(key)
+
+    def __getitem__(self, key):
+        return self.atomIds[key]
+
+    def __contains__(self, key):
+        return key in self.atomIds
+
+    def __iter__(self):
+        return iter(self.atomIds)
+
+    def __len__(self):
+        return len(self.atomIds)
+
+    def Find(self, resName = None, chain = None, resNum = None):
+        """keys of the residues matching the given residue name, chain and residue number"""
+        return [key for key in self.atomIds
+                if (resName is None or key.resName == resName.strip())
+                and (chain is None or key.chain == chain.strip())
+                and (resNum is None or key.resNum == resNum)]
+
+    def ResidueAtoms(self, resName):
+        """atom ids of all residues with the given residue name"""
+        ids = []
+        for key in self.Find(resName = resName):
+            ids.extend(self.atomIds[key])
+        return sorted(ids)
+
+    def Ligands(self, includeWater = False):
+        """keys of the HETATM residues (waters only if includeWater)"""
+        return [key for key in self.atomIds if key in self.hetero
+                and (includeWater or key.resName not in WATER_RESIDUES)]
+
+
+class ResidueGrid(object):
+    """spatial grid over the atoms of a mol object created from pdb file, built once and used to
+    find the atoms and residues within a radius of a set of points (e.g. ligand coordinates)"""
+
+    def __init__(self, mol, cellSize = 4.0, confId = -1, residueIndex = None):
+        if residueIndex is None:
+            residueIndex = ResidueIndex(mol)
+        self.residueIndex = residueIndex
+        self.cellSize = float(cellSize)
+        self.positions = mol.GetConformer(confId).GetPositions()
+
+        # residue of every atom (as position in residueKeys, -1 without residue info)
+        self.residueKeys = list(residueIndex)
+        self.atomResidue = np.full(len(self.positions), -1, dtype=int)
+        for i, key in enumerate(self.residueKeys):
+            self.atomResidue[residueIndex[key]] = i
+
+        # {cell: atom ids}, grouped from the atoms sorted by cell
+        cells = np.floor(self.positions / self.cellSize).astype(np.int64)
+        order = np.lexsort((cells[:, 2], cells[:, 1], cells[:, 0]))
+        sortedCells = cells[order]
+        starts = np.flatnonzero(np.any(np.diff(sortedCells, axis=0) != 0, axis=1)) + 1
+        self.cells = {}
+        for atomIds in np.split(order, starts):
+            if len(atomIds) > 0:
+                self.cells[tuple(cells[atomIds[0]])] = atomIds
+
+    def AtomsWithin(self, points, radius, chunkSize = 256):
+        """sorted ids of the atoms within radius of any of the points
+
+        The points are bucketed into the cells of the grid and each bucket (at most chunkSize points at
+        a time) is only compared with the atoms of the neighbouring cells, so memory does not grow with
+        the number of points times the number of candidate atoms"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if len(points) == 0 or len(self.cells) == 0:
+            return np.array([], dtype=int)
+
+        reach = int(np.ceil(radius / self.cellSize))
+        offsets = [(i, j, k) for i in range(-reach, reach + 1)
+                             for j in range(-reach, reach + 1)
+                             for k in range(-reach, reach + 1)]
+
+        pointCells = np.floor(points / self.cellSize).astype(np.int64)
+        order = np.lexsort((pointCells[:, 2], pointCells[:, 1], pointCells[:, 0]))
+        starts = np.flatnonzero(np.any(np.diff(pointCells[order], axis=0) != 0, axis=1)) + 1
+
+        found = np.zeros(len(self.positions), dtype=bool)
+        for pointIds in np.split(order, starts):
+            (x, y, z) = pointCells[pointIds[0]]
+            near = [self.cells[cell] for cell in ((x + i, y + j, z + k) for (i, j, k) in offsets)
+                    if cell in self.cells]
+            if len(near) == 0:
+                continue
+            near = np.concatenate(near)
+            for chunk in range(0, len(pointIds), chunkSize):
+                # atoms already found need no more distances
+                near = near[~found[near]]
+                if len(near) == 0:
+                    break
+                diff = self.positions[near][:, None, :] - points[pointIds[chunk:chunk + chunkSize]][None, :, :]
+                found[near[np.any(np.einsum('ijk,ijk->ij', diff, diff) <= radius * radius, axis=1)]] = True
+        return np.flatnonzero(found)
+
+    def ResiduesWithin(self, points, radius):
+        """keys of the residues having at least one atom within radius of the points"""
+        residues = np.unique(self.atomResidue[self.AtomsWithin(points, radius)])
+        return [self.residueKeys[i] for i in residues if i >= 0]
+
+    def ResidueAtomsWithin(self, points, radius):
+        """sorted ids of all atoms of the residues within radius of the points (whole residues)"""
+        atomIds = []
+        for key in self.ResiduesWithin(points, radius):
+            atomIds.extend(self.residueIndex[key])
+        return sorted(atomIds)
+
+
+def ResidueKeyToStr(key, prefix = ''):
+    """string id of a residue (e.g. for the keys of ligandDict)"""
+    name = '{}_{}{}'.format(key.resName, key.chain, key.resNum)
+    return prefix + '_' + name if prefix else name
+
 
 ## Ligand Extract
 
 ExtractResult = namedtuple('ExtractResult',('match','rest'))
-def ExtractMolAtomsMatchingQuery(mol,func, confId,sanitize, includeAttachedHs):
-    """this extracts ligand from mol object (mol object created from pdb file)"""
-    
-    match = [x for x in range(mol.GetNumAtoms()) if func(x)]
-    
-    if includeAttachedHs:
-        # bring over H atoms attached to the atoms matching the query (if necessary)
-        for aid in match:
-            for nbr in mol.GetAtomWithIdx(aid).GetNeighbors():
-                if nbr.GetAtomicNum()==1 and nbr.GetIdx() not in match:
-                    match.append(nbr.GetIdx())
-                    
-    res2 = Chem.RWMol(mol)
-    for i in sorted(match, reverse=True):
-        res2.RemoveAtom(i)
-    if sanitize:
-        Chem.SanitizeMol(res2)
-    
+BulkExtractResult = namedtuple('BulkExtractResult',('matches','rest'))
+
+def SetConformerPositions(conf, xyz):
+    """copies an (nAtoms, 3) coordinate array into a conformer, in one call where RDKit has
+    Conformer.SetPositions and atom by atom otherwise"""
+    if hasattr(conf, 'SetPositions'):
+        conf.SetPositions(np.ascontiguousarray(xyz, dtype=np.float64))
+    else:
+        for i, (x, y, z) in enumerate(xyz):
+            conf.SetAtomPosition(i, Point3D(x, y, z))
+
+def MolFromAtomIds(mol, atomIds, confId = -1, sanitize = True):
+    """builds a new mol object from the given atoms of mol (atoms, bonds between them and coordinates)
+
+    confId='allConfs' copies every conformer (e.g. all models of an NMR ensemble or MD snapshots),
+    the coordinates of each conformer are sliced out of the parent coordinates in one go
+    """
     res = Chem.RWMol()
-    
-    # start with all atoms and their coordinates:
-    # Should probably also handle multiple conformers
-    oldConf = mol.GetConformer(confId)
-    newConf = Chem.Conformer(len(match))
-    newConf.SetId(oldConf.GetId())
+
+    # start with all atoms:
     old_new_map={}
-    for i,aid in enumerate(match):
+    for i,aid in enumerate(atomIds):
         res.AddAtom(mol.GetAtomWithIdx(aid))
-        newConf.SetAtomPosition(i,oldConf.GetAtomPosition(aid))
         old_new_map[aid] = i
-    res.AddConformer(newConf)
-    
+
+    # and their coordinates:
+    if confId == 'allConfs':
+        oldConfs = list(mol.GetConformers())
+    else:
+        oldConfs = [mol.GetConformer(confId)]
+    atomIdArray = np.array(atomIds, dtype=int)
+    for oldConf in oldConfs:
+        newConf = Chem.Conformer(len(atomIds))
+        newConf.SetId(oldConf.GetId())
+        newConf.Set3D(oldConf.Is3D())
+        SetConformerPositions(newConf, oldConf.GetPositions()[atomIdArray])
+        res.AddConformer(newConf, assignId=False)
+
     # bonds:
-    for i,aid in enumerate(match):
+    for i,aid in enumerate(atomIds):
         for nbr in mol.GetAtomWithIdx(aid).GetNeighbors():
             if nbr.GetIdx() not in old_new_map:
                 continue
@@ -55,18 +201,252 @@ def ExtractMolAtomsMatchingQuery(mol,func, confId,sanitize, includeAttachedHs):
             res.AddBond(old_new_map[aid],old_new_map[nbr.GetIdx()],bnd.GetBondType())
     if sanitize:
         Chem.SanitizeMol(res)
-    return ExtractResult(res.GetMol(), res2.GetMol())
-    
-def ExtractMolFragment(mol, ResName, confId=-1,sanitize=True, includeAttachedHs=True):
-    """extracting fragments from mol object"""
-    ids=list()
-    for Idx in range(mol.GetNumAtoms()-1):
-        atom=mol.GetAtomWithIdx(Idx)
-        if atom.GetPDBResidueInfo().GetResidueName() == ResName:
-            ids.append(atom.GetIdx())
-    return ExtractMolAtomsMatchingQuery(mol, lambda x,y = ids : x in y, confId,sanitize, includeAttachedHs)
-    
-    
-    
-    
-    
\ No newline at end of file
+    return res.GetMol()
+
+def _AddAttachedHs(mol, match):
+    """bring over H atoms attached to the atoms matching the query"""
+    match = list(match)
+    matchSet = set(match)
+    for aid in list(match):
+        for nbr in mol.GetAtomWithIdx(aid).GetNeighbors():
+            if nbr.GetAtomicNum()==1 and nbr.GetIdx() not in matchSet:
+                match.append(nbr.GetIdx())
+                matchSet.add(nbr.GetIdx())
+    return match
+
+def _AddTiming(timings, name, start):
+    """accumulate the time since start under name (if timings are requested)"""
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + time.time() - start
+
+def _RemoveAtoms(mol, atomIds, sanitizeRest = True, restMethod = 'batch', timings = None):
+    """copy of mol without the given atoms
+
+    restMethod 'batch' removes all atoms in one batched edit (one renumbering of the molecule),
+    'remove' removes them one by one; 'batch' falls back to 'remove' on RDKit versions without
+    batch editing. sanitizeRest can be True, False or SanitizeFlags to limit the sanitization.
+    """
+    if restMethod not in ('batch', 'remove'):
+        raise ValueError("restMethod can be batch or remove")
+
+    start = time.time()
+    res2 = Chem.RWMol(mol)
+    if restMethod == 'batch' and hasattr(res2, 'BeginBatchEdit'):
+        res2.BeginBatchEdit()
+        for i in atomIds:
+            res2.RemoveAtom(i)
+        res2.CommitBatchEdit()
+    else:
+        for i in sorted(atomIds, reverse=True):
+            res2.RemoveAtom(i)
+    _AddTiming(timings, 'rest', start)
+
+    start = time.time()
+    if sanitizeRest is True:
+        Chem.SanitizeMol(res2)
+    elif sanitizeRest is not False:
+        Chem.SanitizeMol(res2, sanitizeOps = sanitizeRest)
+    _AddTiming(timings, 'sanitizeRest', start)
+
+    return res2.GetMol()
+
+def ExtractMolAtoms(mol, atomIds, confId = -1, sanitize = True, includeAttachedHs = True,
+                    sanitizeRest = None, restMethod = 'batch', timings = None):
+    """this splits mol object into the given atoms and the rest
+
+    sanitizeRest (default: same as sanitize) can be False or SanitizeFlags to skip or limit the
+    sanitization of the (large) rest molecule; timings, if a dict, receives the seconds spent
+    on the match, the rest and its sanitization
+    """
+    match = list(atomIds)
+
+    if includeAttachedHs:
+        # bring over H atoms attached to the atoms matching the query (if necessary)
+        match = _AddAttachedHs(mol, match)
+
+    if sanitizeRest is None:
+        sanitizeRest = sanitize
+
+    rest = _RemoveAtoms(mol, match, sanitizeRest, restMethod, timings)
+
+    start = time.time()
+    res = MolFromAtomIds(mol, match, confId, sanitize)
+    _AddTiming(timings, 'match', start)
+
+    return ExtractResult(res, rest)
+
+def ExtractMolAtomsMatchingQuery(mol,func, confId,sanitize, includeAttachedHs,
+                                 sanitizeRest = None, restMethod = 'batch', timings = None):
+    """this extracts ligand from mol object (mol object created from pdb file)"""
+
+    match = [x for x in range(mol.GetNumAtoms()) if func(x)]
+    return ExtractMolAtoms(mol, match, confId, sanitize, includeAttachedHs,
+                           sanitizeRest, restMethod, timings)
+
+def ExtractMolFragment(mol, ResName, confId=-1,sanitize=True, includeAttachedHs=True, residueIndex=None,
+                       sanitizeRest=None, restMethod='batch', timings=None):
+    """extracting fragments from mol object
+
+    confId='allConfs' extracts the fragment with all conformers of mol (multi-model PDB files).
+    residueIndex (ResidueIndex of mol) can be given to avoid scanning mol again when
+    extracting several fragments from the same mol object
+    """
+    start = time.time()
+    if residueIndex is None:
+        residueIndex = ResidueIndex(mol)
+    ids = residueIndex.ResidueAtoms(ResName)
+    _AddTiming(timings, 'index', start)
+    return ExtractMolAtoms(mol, ids, confId, sanitize, includeAttachedHs,
+                           sanitizeRest, restMethod, timings)
+
+def ExtractLigands(mol, ligands=None, confId=-1, sanitize=True, includeAttachedHs=True,
+                   includeWater=False, residueIndex=None,
+                   sanitizeRest=None, restMethod='batch', timings=None, keepRest=True):
+    """extracting several ligands from mol object in a single pass
+
+    ligands is a list of residue names (all residues of that name) and/or (chain, resName, resNum)
+    keys; by default all HETATM residues except waters are extracted. Returns the ligands as
+    {ResidueKey: mol} and one rest molecule with all of them removed (None if not keepRest).
+    confId='allConfs' extracts every ligand with all conformers of mol.
+    """
+    start = time.time()
+    if residueIndex is None:
+        residueIndex = ResidueIndex(mol)
+    _AddTiming(timings, 'index', start)
+
+    if ligands is None:
+        keys = residueIndex.Ligands(includeWater)
+    else:
+        keys = []
+        for ligand in ligands:
+            if isinstance(ligand, tuple):
+                keys.append(ResidueKey(*ligand))
+            else:
+                keys.extend(residueIndex.Find(resName = ligand))
+
+    start = time.time()
+    matches = OrderedDict()
+    removed = set()
+    for key in keys:
+        match = residueIndex[key]
+        if includeAttachedHs:
+            match = _AddAttachedHs(mol, match)
+        matches[key] = MolFromAtomIds(mol, match, confId, sanitize)
+        removed.update(match)
+    _AddTiming(timings, 'match', start)
+
+    if not keepRest:
+        return BulkExtractResult(matches, None)
+
+    if sanitizeRest is None:
+        sanitizeRest = sanitize
+
+    return BulkExtractResult(matches, _RemoveAtoms(mol, removed, sanitizeRest, restMethod, timings))
+
+
+## Ligand extraction over many pdb files
+
+PDB_EXTENSIONS = ('.pdb', '.ent')
+
+FileExtractResult = namedtuple('FileExtractResult', ('path', 'ligands', 'time', 'error'))
+FileExtractReport = namedtuple('FileExtractReport', ('path', 'nLigands', 'time', 'error'))
+
+def IterPDBFiles(paths, extensions = PDB_EXTENSIONS):
+    """yields pdb file paths lazily from a file, a directory (walked recursively) or a list of them"""
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(extensions):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+def _ExtractLigandsFromFile(job):
+    """reads one pdb file and extracts its ligands (process pool worker); errors are reported, not raised"""
+    path, ligands, removeHs, kwargs = job
+    start = time.time()
+    try:
+        mol = Chem.MolFromPDBFile(path, removeHs = removeHs)
+        if mol is None:
+            raise ValueError('RDKit could not read ' + path)
+        result = ExtractLigands(mol, ligands, keepRest = False, **kwargs)
+        prefix = os.path.splitext(os.path.basename(path))[0]
+        extracted = [(ResidueKeyToStr(key, prefix), lig) for key, lig in result.matches.items()]
+        return FileExtractResult(path, extracted, time.time() - start, None)
+    except Exception as e:
+        return FileExtractResult(path, [], time.time() - start, '{}: {}'.format(type(e).__name__, e))
+
+def ExtractLigandsFromFiles(paths, ligands=None, nWorkers=1, maxPending=None, removeHs=False,
+                            confId=-1, sanitize=True, includeAttachedHs=True, includeWater=False):
+    """streaming ligand extraction over many pdb files
+
+    Files are read lazily and processed by a pool of nWorkers processes; at most maxPending
+    (default 2*nWorkers) files are in flight, so memory stays bounded. Yields one FileExtractResult
+    (path, [(ligand name, mol)], seconds, error or None) per file in input order; ligand names are
+    '<file name>_<resName>_<chain><resNum>'.
+    """
+    if nWorkers < 1:
+        raise ValueError("nWorkers must be a positive integer")
+    if maxPending is None:
+        maxPending = 2 * nWorkers
+
+    kwargs = dict(confId = confId, sanitize = sanitize, includeAttachedHs = includeAttachedHs,
+                  includeWater = includeWater)
+    jobs = ((path, ligands, removeHs, kwargs) for path in IterPDBFiles(paths))
+
+    if nWorkers == 1:
+        for job in jobs:
+            yield _ExtractLigandsFromFile(job)
+        return
+
+    with ProcessPoolExecutor(max_workers = nWorkers) as executor:
+        pending = deque()
+        for job in jobs:
+            pending.append(executor.submit(_ExtractLigandsFromFile, job))
+            if len(pending) >= maxPending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def StreamLigands(paths, sdfPath=None, ligandDict=None, keyForParentMol='parent', **kwargs):
+    """runs ExtractLigandsFromFiles and streams the ligands into an SD file and/or a ligandDict
+
+    Every conformer of a ligand is written as a separate SD record named after the ligand; in
+    ligandDict each ligand is stored as {keyForParentMol: mol} (the ProcessLigandDict layout).
+    Other keyword arguments go to ExtractLigandsFromFiles. A name that is already taken (files
+    with the same name in different directories, or keys already in ligandDict) gets the suffix
+    _2, _3, ... Returns one FileExtractReport (path, number of ligands, seconds, error or None)
+    per file.
+    """
+    writer = Chem.SDWriter(sdfPath) if sdfPath is not None else None
+    report = []
+    usedNames = set(ligandDict) if ligandDict is not None else set()
+    try:
+        for result in ExtractLigandsFromFiles(paths, **kwargs):
+            for name, lig in result.ligands:
+                if name in usedNames:
+                    suffix = 2
+                    while '{}_{}'.format(name, suffix) in usedNames:
+                        suffix += 1
+                    name = '{}_{}'.format(name, suffix)
+                usedNames.add(name)
+                lig.SetProp('_Name', name)
+                if writer is not None:
+                    for conf in lig.GetConformers():
+                        writer.write(lig, confId = conf.GetId())
+                if ligandDict is not None:
+                    ligandDict[name] = {keyForParentMol: lig}
+            report.append(FileExtractReport(result.path, len(result.ligands), result.time, result.error))
+    finally:
+        if writer is not None:
+            writer.close()
+    return report
+
+
+
+
+